@@ -11,12 +11,16 @@ import time
 import sys
 
 from atomicwrites import atomic_write
-from wcwidth import wcwidth, wcswidth
 
 from .app import Application
 from .document import (
-    TextDocument, Style, CellLocation, DocumentLocation, WCHAR_RIGHT
+    TextDocument, Style, CellLocation, DocumentLocation, WrapIndex
 )
+from .width import char_width, text_width
+
+# Files at least this many bytes in size are memory-mapped when opened rather
+# than being read into memory.
+MAP_FILE_THRESHOLD = 16 * 1024 * 1024
 
 def main():
     app = Editor()
@@ -48,6 +52,25 @@ class TerminalPalette256(enum.IntEnum):
     BRIGHT_YELLOW = 227
     BRIGHT_WHITE = 231
 
+# Maximum time, in seconds, spent highlighting the document before returning to
+# the event loop.
+HIGHLIGHT_SLICE = 0.01
+
+# Maximum time, in seconds, spent wrapping lines outside of the text view before
+# returning to the event loop.
+WRAP_SLICE = 0.01
+
+# Number of lines wrapped between checks of the time spent wrapping
+WRAP_BATCH_SIZE = 256
+
+# The state of the screen when it was last drawn. A change to n_lines, n_cols,
+# title or scroll_col requires everything to be drawn again; a change to
+# scroll_row is handled by scrolling the text view; a change to max_row or
+# max_col requires the frame and scroll bars to be drawn. Rows and columns are
+# those of the view which, when soft-wrapping, differ from the document's.
+DrawState = collections.namedtuple(
+    'DrawState', 'n_lines n_cols title scroll_col scroll_row max_row max_col')
+
 class FrameStyle(enum.Enum):
     SINGLE = 1
     DOUBLE = 2
@@ -55,15 +78,36 @@ class FrameStyle(enum.Enum):
 class Editor(Application):
     def __init__(self):
         super(Editor, self).__init__()
-        self._redraw_scheduled = False
 
         self._document = TextDocument()
+        self._document.change_listeners.append(self._document_changed)
+        self._document.style_listeners.append(self._document_styled)
         self._filename = None
 
+        # Damage to be repainted by the next draw(). Lines are document line
+        # indices and, if not None, every line from _dirty_from onwards is
+        # damaged. The state of the screen when last drawn is recorded so that
+        # scrolling and resizing can be detected.
+        self._dirty_lines = set()
+        self._dirty_from = None
+        self._full_redraw = True
+        self._drawn_state = None
+
+        # The pending call to _highlight_step(), if any, and whether it is to
+        # be made as soon as possible to highlight visible rows
+        self._highlight_callback = None
+        self._highlight_urgent = False
+
+        # When soft-wrapping, a WrapIndex for the document. Otherwise None.
+        # The pending call to _wrap_step(), if any.
+        self._wrap = None
+        self._wrap_callback = None
+
         # A simple dictionary mapping key-presses to callables.
         self.key_bindings = {
             ctrl('q'): self.quit,
             ctrl('s'): self.save,
+            ctrl('w'): self.toggle_wrap,
 
             '\n': self.insert_newline,
             curses.KEY_ENTER: self.insert_newline,
@@ -84,7 +128,8 @@ class Editor(Application):
         }
 
         # The scroll position within the document is represented as the cell
-        # location of the upper-left corner
+        # location of the upper-left corner. When soft-wrapping, the row is a
+        # row of the wrapped view and the column is always 0.
         self.scroll = CellLocation(0, 0)
 
         # Desired cell cursor position after motion
@@ -101,7 +146,13 @@ class Editor(Application):
 
     @document.setter
     def document(self, value):
+        self._document.change_listeners.remove(self._document_changed)
+        self._document.style_listeners.remove(self._document_styled)
         self._document = value
+        self._document.change_listeners.append(self._document_changed)
+        self._document.style_listeners.append(self._document_styled)
+        self._reset_wrap()
+        self._full_redraw = True
         self.redraw()
 
     ### Motion commands
@@ -128,7 +179,7 @@ class Editor(Application):
             self.move_down()
 
         _, sc = self.scroll
-        sr, _ = self.document.cursor_cell
+        sr, _ = self._cursor_view_cell()
         self.scroll = CellLocation(sr, sc)
 
     def move_up(self):
@@ -141,9 +192,29 @@ class Editor(Application):
             self.move_up()
 
         _, sc = self.scroll
-        sr = self.document.max_row
+        sr, _ = self._view_size()
         self.scroll = CellLocation(sr, sc)
 
+    ### View commands
+
+    def toggle_wrap(self):
+        """Switch soft-wrapping of long lines on or off. The line at the top of
+        the text view stays there.
+
+        """
+        if self._wrap is None:
+            top_line = self.scroll.row
+            self._wrap = WrapIndex(self.document, self.n_cols - 2)
+        else:
+            top_line, _ = self._wrap.line_at_row(self.scroll.row)
+            self._wrap = None
+            self._cancel_wrap_step()
+
+        # Until lines are wrapped each occupies one row
+        self.scroll = CellLocation(top_line, 0)
+        self._full_redraw = True
+        self.redraw()
+
     ### Editing
 
     def insert_character(self, ch):
@@ -154,6 +225,10 @@ class Editor(Application):
         self.document.insert_newline()
         self.document.move_forward()
 
+    def insert_text(self, text):
+        self.document.move_cursor(
+            self.document.insert_text(self.document.cursor, text))
+
     def backspace(self):
         self.document.move_backward()
         self.document.delete_character()
@@ -164,19 +239,36 @@ class Editor(Application):
     ### File I/O
 
     def open(self, filename):
-        with open(filename) as f:
-            self.document.read_from_file(f)
-            self._filename = filename
+        if os.path.getsize(filename) >= MAP_FILE_THRESHOLD:
+            with open(filename, 'rb') as f:
+                self.document.read_from_mapped_file(f)
+        else:
+            with open(filename) as f:
+                self.document.read_from_file(f)
+        self._filename = filename
+        self._reset_wrap()
+        self._full_redraw = True
+        self.redraw()
 
     def save(self):
-        with atomic_write(self._filename, overwrite=True) as f:
-            self.document.write_to_file(f)
+        if self.document.encoding is None:
+            with atomic_write(self._filename, overwrite=True) as f:
+                self.document.write_to_file(f)
+            return
+
+        # Memory-mapped files are written back byte for byte where unchanged
+        with atomic_write(self._filename, mode='wb', overwrite=True) as f:
+            self.document.write_to_binary_file(f)
 
     ### Event handlers
 
     def start(self):
         setup_curses_colour_pairs()
 
+        # Allow curses to use the terminal's line insertion, deletion and
+        # scrolling when updating the screen.
+        self.screen.idlok(1)
+
     def resize(self):
         self.redraw()
 
@@ -198,67 +290,99 @@ class Editor(Application):
 
         self.redraw()
 
-    def redraw(self):
-        if not self._redraw_scheduled:
-            self._redraw_scheduled = True
-            self.add_timer(0, self._redraw)
-
-    def _redraw(self):
-        """Redraw the screen."""
-        # Reset redraw schedule flag
-        self._redraw_scheduled = False
+    def paste(self, text):
+        self.insert_text(text)
+        _, self.desired_x = self.document.cursor_cell
+        self.redraw()
 
+    def draw(self):
+        """Redraw the damaged parts of the screen."""
         # Move cursor to be within text document bounds
         curses.curs_set(0)
         self.screen.leaveok(1)
 
-        self.screen.bkgdset(' ', style_attr(Style.WINDOW_BACKGROUND))
-        self.screen.erase()
+        n_vis_rows = self.n_lines - 3
+        n_vis_cols = self.n_cols - 2
+
+        # Update scroll position. When soft-wrapping, wrapping the lines in
+        # view can move the cursor and scrolling can bring lines which have not
+        # been wrapped into view and so both are repeated until the scroll
+        # position settles.
+        while True:
+            scroll = self.scroll
+            if self._wrap is not None:
+                self._wrap_view(n_vis_rows, n_vis_cols)
+            self._update_scroll(
+                self._cursor_view_cell(), n_vis_rows, n_vis_cols)
+            if self._wrap is None or self.scroll == scroll:
+                break
+        ccy, ccx = self._cursor_view_cell()
 
-        # Draw frame for text view
         title = self._filename if self._filename is not None else 'Untitled'
-        draw_window_frame(
-            self.screen, 0, 0, self.n_lines - 1, self.n_cols,
-            title=title, frame_style=FrameStyle.DOUBLE)
+        max_row, max_col = self._view_size()
+        state = DrawState(
+            self.n_lines, self.n_cols, title, self.scroll.col, self.scroll.row,
+            max_row, max_col)
+        last = self._drawn_state
+        scroll_delta = 0 if last is None else state.scroll_row - last.scroll_row
+
+        # Work out what needs drawing. If only the cursor has moved, nothing
+        # does.
+        if (self._full_redraw or last is None or state[:4] != last[:4]
+                or abs(scroll_delta) >= n_vis_rows):
+            self.screen.bkgdset(' ', style_attr(Style.WINDOW_BACKGROUND))
+            self.screen.erase()
+            rows, draw_chrome, draw_status = range(n_vis_rows), True, True
+        else:
+            # Rows already on screen are moved by scrolling the text view and
+            # so only the newly exposed rows need to be drawn.
+            if scroll_delta > 0:
+                exposed = range(n_vis_rows - scroll_delta, n_vis_rows)
+            else:
+                exposed = range(0, -scroll_delta)
+            if scroll_delta != 0:
+                self._scroll_text_view(scroll_delta, n_vis_rows)
+
+            rows = [
+                vis_row for vis_row in range(n_vis_rows)
+                if vis_row in exposed
+                or self._is_line_dirty(self._row_line(vis_row))
+            ]
+            draw_chrome = scroll_delta != 0 or state[5:] != last[5:]
+            draw_status = False
+
+        self._dirty_lines.clear()
+        self._dirty_from = None
+        self._full_redraw = False
+        self._drawn_state = state
 
         # Draw text content
-        n_vis_rows = self.n_lines - 3
-        n_vis_cols = self.n_cols - 2
+        if self.n_cols > 2:
+            for vis_row in rows:
+                self._draw_text_row(vis_row, n_vis_cols)
 
-        # Update scroll position
-        self._update_scroll(self.document.cursor_cell, n_vis_rows, n_vis_cols)
-        ccy, ccx = self.document.cursor_cell
+        if draw_chrome:
+            # Draw frame for text view
+            draw_window_frame(
+                self.screen, 0, 0, self.n_lines - 1, self.n_cols,
+                title=title, frame_style=FrameStyle.DOUBLE)
 
-        if self.n_cols > 2:
-            for doc_y in range(n_vis_rows):
-                win_y = 1 + doc_y
-                line_cells = self.document.get_cells_for_row(self.scroll.row + doc_y)
-
-                if line_cells is None:
-                    s_line = [('\u2591' * n_vis_cols, Style.HL_DRAGONS)]
-                else:
-                    s_line = []
-                    sx = self.scroll.col
-                    for cell in line_cells[sx:sx + n_vis_cols]:
-                        if cell is WCHAR_RIGHT and len(s_line) > 0:
-                            continue
-                        s_line.append((cell.char, cell.style))
-                    s_line = normalise_styled_text(s_line)
-
-                draw_regions(self.screen, s_line, win_y, 1, self.n_cols-2)
-
-        # Draw scroll bars
-        if self.n_lines > 3 and n_vis_rows < self.document.max_row:
-            draw_v_scroll(
-                self.screen, self.n_cols-1, 1, self.n_lines-3,
-                self.scroll.row, n_vis_rows, self.document.max_row)
-
-        if self.n_cols > 3 and n_vis_cols < self.document.max_col:
-            draw_h_scroll(
-                self.screen, 1, self.n_lines-2, self.n_cols-2,
-                self.scroll.col, n_vis_cols, self.document.max_col)
-
-        self._draw_status()
+            # Draw scroll bars
+            if self.n_lines > 3 and n_vis_rows < max_row:
+                draw_v_scroll(
+                    self.screen, self.n_cols-1, 1, self.n_lines-3,
+                    self.scroll.row, n_vis_rows, max_row)
+
+            if self.n_cols > 3 and n_vis_cols < max_col:
+                draw_h_scroll(
+                    self.screen, 1, self.n_lines-2, self.n_cols-2,
+                    self.scroll.col, n_vis_cols, max_col)
+
+        if draw_status:
+            self._draw_status()
+
+        self._schedule_highlight()
+        self._schedule_wrap()
 
         # Calculate on-screen cursor pos
         scy = ccy - self.scroll.row + 1
@@ -286,7 +410,8 @@ class Editor(Application):
             sr = cursor_cell.row
         elif cursor_cell.row >= sr + win_rows:
             sr = max(0, cursor_cell.row - win_rows + 1)
-        sr = min(sr, max(0, self.document.max_row - win_rows + 1))
+        max_row, max_col = self._view_size()
+        sr = min(sr, max(0, max_row - win_rows + 1))
 
         # update col
         if win_cols < 1:
@@ -295,11 +420,318 @@ class Editor(Application):
             sc = cursor_cell.col
         elif cursor_cell.col >= sc + win_cols:
             sc = max(0, cursor_cell.col - win_cols + 1)
-        sc = min(sc, max(0, self.document.max_col - win_cols + 1))
+        sc = min(sc, max(0, max_col - win_cols + 1))
 
         # set new scroll position
         self.scroll = CellLocation(sr, sc)
 
+    def _document_changed(self, first, n_removed, n_inserted):
+        """Record damage after n_removed lines of the document starting at
+        first have been replaced by n_inserted lines.
+
+        """
+        above_view = False
+        if self._wrap is not None:
+            above_view = self._rewrap(first, n_removed, n_inserted)
+
+        drawn = self._drawn_state
+        if drawn is None:
+            return
+
+        # Edited lines are drawn without highlighting until they are lexed
+        # again and so are highlighted before the next frame if they are
+        # visible.
+        self._schedule_highlight()
+
+        if self._wrap is not None:
+            # The rows of changed lines are unknown until they are wrapped
+            # again and so every row from the first changed line may move.
+            # Changes above the view have been scrolled past.
+            if not above_view and (
+                    self._dirty_from is None or first < self._dirty_from):
+                self._dirty_from = first
+        elif n_removed == n_inserted:
+            # Only lines on screen are damaged. Others will be drawn in full
+            # when they are scrolled into view.
+            start = max(first, drawn.scroll_row)
+            end = min(first + n_inserted, drawn.scroll_row + drawn.n_lines - 3)
+            if start >= end:
+                return
+            self._dirty_lines.update(range(start, end))
+        elif self._dirty_from is None or first < self._dirty_from:
+            # Lines below have moved
+            self._dirty_from = first
+        self.redraw()
+
+    def _document_styled(self, first, n_lines):
+        """Record damage after the highlighting of n_lines lines of the document
+        starting at first has changed. Their rows are unchanged.
+
+        """
+        drawn = self._drawn_state
+        if drawn is None:
+            return
+
+        # Only lines on screen are damaged. Others will be drawn in full when
+        # they are scrolled into view.
+        n_vis_rows = drawn.n_lines - 3
+        if self._wrap is None:
+            top_line, end_line = drawn.scroll_row, drawn.scroll_row + n_vis_rows
+        else:
+            top_line, _ = self._wrap.line_at_row(drawn.scroll_row)
+            end_line, _ = self._wrap.line_at_row(
+                drawn.scroll_row + max(0, n_vis_rows - 1))
+            end_line += 1
+        start, end = max(first, top_line), min(first + n_lines, end_line)
+        if start >= end:
+            return
+        self._dirty_lines.update(range(start, end))
+        self.redraw()
+
+    def _schedule_highlight(self):
+        """Arrange for _highlight_step() to be called if the document's
+        highlighting is not up to date.
+
+        """
+        if self.document.highlighted_lines >= self.document.max_row:
+            return
+
+        # Visible lines which have not been lexed are highlighted as soon as
+        # possible. The rest of the document is highlighted, and visible lines
+        # lexed ahead of those before them are checked, only while there is no
+        # input to process.
+        urgent = self.document.needs_highlight(*self._visible_lines())
+        callback = self._highlight_callback
+        if callback is not None and callback.pending:
+            if self._highlight_urgent or not urgent:
+                return
+            callback.cancel()
+
+        self._highlight_urgent = urgent
+        if urgent:
+            self._highlight_callback = self.add_timer(0, self._highlight_step)
+        else:
+            self._highlight_callback = self.add_idle(self._highlight_step)
+
+    def _highlight_step(self):
+        """Highlight the document for at most HIGHLIGHT_SLICE seconds, lexing
+        visible lines which have not been lexed first. Rows whose highlighting
+        changes are redrawn.
+
+        """
+        deadline = time.monotonic() + HIGHLIGHT_SLICE
+        first, end = self._visible_lines()
+        if self.document.highlight_ahead(first, end, deadline):
+            self.document.highlight(self.document.max_row, deadline)
+        self._schedule_highlight()
+
+    def _reset_wrap(self):
+        """Start wrapping afresh after the document has been replaced."""
+        if self._wrap is not None:
+            self._wrap = WrapIndex(self.document, self._wrap.width)
+            self.scroll = CellLocation(0, 0)
+
+    def _view_size(self):
+        """Return the number of rows and columns in the view of the document.
+        When soft-wrapping the view has no columns beyond the text view's.
+
+        """
+        if self._wrap is not None:
+            return self._wrap.n_rows, 0
+        return self.document.max_row, self.document.max_col
+
+    def _cursor_view_cell(self):
+        """Return a CellLocation giving the cursor's row and column within the
+        view of the document.
+
+        """
+        row, col = self.document.cursor_cell
+        wrap = self._wrap
+        if wrap is None:
+            return CellLocation(row, col)
+        if row < self.document.max_row:
+            self._wrap_lines([row])
+        return CellLocation(
+            wrap.row_of_line(row) + col // wrap.width, col % wrap.width)
+
+    def _row_line(self, vis_row):
+        """Return the index of the document line shown at a row of the text
+        view.
+
+        """
+        if self._wrap is None:
+            return self.scroll.row + vis_row
+        line_idx, _ = self._wrap.line_at_row(self.scroll.row + vis_row)
+        return line_idx
+
+    def _visible_lines(self):
+        """Return the indices of the first visible line of the document and of
+        the line after the last.
+
+        """
+        return self._row_line(0), self._row_line(self.n_lines - 4) + 1
+
+    def _wrap_view(self, n_vis_rows, n_vis_cols):
+        """Wrap the lines in the text view to its width."""
+        wrap = self._wrap
+        if wrap.width != max(1, n_vis_cols):
+            # Every line is unwrapped when the width changes. Keep the line at
+            # the top of the view in place.
+            top_line, _ = wrap.line_at_row(self.scroll.row)
+            wrap.width = n_vis_cols
+            self.scroll = CellLocation(top_line, 0)
+
+        line_idx, sub_row = wrap.line_at_row(self.scroll.row)
+        n_rows = -sub_row
+        while n_rows < n_vis_rows and line_idx < self.document.max_row:
+            self._wrap_lines([line_idx])
+            n_rows += wrap.line_rows(line_idx)
+            line_idx += 1
+
+    def _wrap_lines(self, line_indices):
+        """Wrap lines. Lines above the text view moving the rows within it are
+        compensated for by scrolling, both the view to be drawn and the screen
+        as last drawn, so that the screen need not change. Lines whose rows
+        change on screen are damaged along with those below. Return True if the
+        rows of any line changed.
+
+        """
+        wrap = self._wrap
+        top_line, _ = wrap.line_at_row(self.scroll.row)
+        drawn = self._drawn_state
+        drawn_top_line = top_line
+        if drawn is not None:
+            drawn_top_line, _ = wrap.line_at_row(drawn.scroll_row)
+
+        changed = False
+        for line_idx in line_indices:
+            delta = wrap.wrap_line(line_idx)
+            if delta == 0:
+                continue
+            self._shift_scroll(
+                delta if line_idx < top_line else 0,
+                delta if line_idx < drawn_top_line else 0)
+            if line_idx >= drawn_top_line and (
+                    self._dirty_from is None or line_idx < self._dirty_from):
+                self._dirty_from = line_idx
+            changed = True
+        return changed
+
+    def _rewrap(self, first, n_removed, n_inserted):
+        """Update the wrap index after n_removed lines of the document starting
+        at first have been replaced by n_inserted lines. Return True if the
+        changed lines are all above the text view as last drawn.
+
+        """
+        wrap = self._wrap
+
+        # The line and row within it at the top of the view to be drawn and at
+        # the top of the screen as last drawn are kept there
+        rows = [self.scroll.row]
+        if self._drawn_state is not None:
+            rows.append(self._drawn_state.scroll_row)
+        anchors = []
+        for row in rows:
+            line_idx, sub_row = wrap.line_at_row(row)
+            if line_idx >= first + max(1, n_removed):
+                line_idx += n_inserted - n_removed
+            elif line_idx >= first:
+                # The line has itself changed and is no longer wrapped
+                line_idx, sub_row = min(line_idx, first + n_inserted), 0
+            anchors.append((line_idx, sub_row))
+        drawn_top_line, _ = wrap.line_at_row(rows[-1])
+        above_view = drawn_top_line >= first + max(1, n_removed)
+
+        wrap.lines_changed(first, n_removed, n_inserted)
+        deltas = [
+            wrap.row_of_line(line_idx) + sub_row - row
+            for row, (line_idx, sub_row) in zip(rows, anchors)
+        ]
+        self._shift_scroll(deltas[0], deltas[-1])
+        return above_view
+
+    def _shift_scroll(self, delta, drawn_delta):
+        """Scroll the view to be drawn by delta rows and take the screen as last
+        drawn to have been scrolled by drawn_delta rows. This follows the
+        content in view after rows have been added or removed above it.
+
+        """
+        if delta != 0:
+            self.scroll = CellLocation(
+                self.scroll.row + delta, self.scroll.col)
+        drawn = self._drawn_state
+        if drawn is not None and drawn_delta != 0:
+            self._drawn_state = drawn._replace(
+                scroll_row=drawn.scroll_row + drawn_delta)
+
+    def _schedule_wrap(self):
+        """Arrange for _wrap_step() to be called if any line of the document is
+        yet to be wrapped.
+
+        """
+        if self._wrap is None or (
+                self._wrap_callback is not None and self._wrap_callback.pending):
+            return
+        if self._wrap.next_unwrapped() is None:
+            return
+        self._wrap_callback = self.add_idle(self._wrap_step)
+
+    def _cancel_wrap_step(self):
+        if self._wrap_callback is not None:
+            self._wrap_callback.cancel()
+            self._wrap_callback = None
+
+    def _wrap_step(self):
+        """Wrap lines for at most WRAP_SLICE seconds so that the vertical scroll
+        bar becomes accurate.
+
+        """
+        deadline = time.monotonic() + WRAP_SLICE
+        line_idx = self._wrap.next_unwrapped()
+        while line_idx is not None and time.monotonic() < deadline:
+            if self._wrap_lines(range(line_idx, min(
+                    line_idx + WRAP_BATCH_SIZE, self.document.max_row))):
+                self.redraw()
+            line_idx = self._wrap.next_unwrapped(line_idx)
+        self._schedule_wrap()
+
+    def _is_line_dirty(self, line_idx):
+        return line_idx in self._dirty_lines or (
+            self._dirty_from is not None and line_idx >= self._dirty_from)
+
+    def _scroll_text_view(self, n_rows, n_vis_rows):
+        """Move the rows of the text view up by n_rows, or down if n_rows is
+        negative. The terminal is asked to scroll the region rather than have
+        each row sent again.
+
+        """
+        self.screen.scrollok(1)
+        self.screen.setscrreg(1, n_vis_rows)
+        self.screen.scroll(n_rows)
+        self.screen.setscrreg(0, self.n_lines - 1)
+        self.screen.scrollok(0)
+
+    def _draw_text_row(self, vis_row, n_vis_cols):
+        """Draw the document row which is visible at a given row of the text
+        view.
+
+        """
+        win_y = 1 + vis_row
+        if self._wrap is None:
+            s_line = self.document.get_regions_for_row(
+                self.scroll.row + vis_row, self.scroll.col, n_vis_cols)
+        else:
+            line_idx, sub_row = self._wrap.line_at_row(self.scroll.row + vis_row)
+            s_line = self.document.get_regions_for_row(
+                line_idx, sub_row * self._wrap.width, n_vis_cols)
+        if s_line is None:
+            s_line = [('\u2591' * n_vis_cols, Style.HL_DRAGONS)]
+
+        # Clear the row before drawing the new content over it
+        draw_regions(self.screen, [(' ' * n_vis_cols, Style.WINDOW_BACKGROUND)],
+                     win_y, 1, n_vis_cols)
+        draw_regions(self.screen, s_line, win_y, 1, n_vis_cols)
+
     def _draw_status(self):
         if self.n_lines < 1:
             return
@@ -315,7 +747,10 @@ class Editor(Application):
             ('Ctrl-Q', Style.STATUS_BAR_HL),
             (' Quit ', Style.STATUS_BAR),
             ('Ctrl-S', Style.STATUS_BAR_HL),
-            (' Save', Style.STATUS_BAR),
+            (' Save ', Style.STATUS_BAR),
+            ('Ctrl-W', Style.STATUS_BAR_HL),
+            (' Unwrap' if self._wrap is not None else ' Wrap',
+             Style.STATUS_BAR),
         ], y=self.n_lines-1, x=0)
 
 def normalise_styled_text(regions):
@@ -329,21 +764,21 @@ def normalise_styled_text(regions):
 
 def wctrim(s, max_w):
     """Return pair s, w which is a string and the cell width of that string. The
-    string is trimmed so that w <= max_w. Characters which wcwidth() reports as
-    having negative width are removed.
+    string is trimmed so that w <= max_w. Characters which char_width() reports
+    as having negative width are removed.
 
     """
     assert max_w >= 0
 
     # Common case: string needs no trimming
-    w = wcswidth(s)
+    w = text_width(s)
     if w >= 0 and w <= max_w:
         return s, w
 
     # Otherwise, walk character by character
     w, chs = 0, []
     for ch in s:
-        ch_w = wcwidth(ch)
+        ch_w = char_width(ch)
         if ch_w < 0:
             continue
 
@@ -383,7 +818,7 @@ def draw_regions(win, regions, y=None, x=None, max_w=None, starting_at=None):
         attr = style_attr(style)
 
         # Get width of region in cells and remaining space
-        region_w = wcswidth(text)
+        region_w = text_width(text)
         w_remaining = nc - x
         assert w_remaining >= 0
 
@@ -399,7 +834,7 @@ def draw_regions(win, regions, y=None, x=None, max_w=None, starting_at=None):
         else:
             # The remaining space is too small, add character-by-character
             for c in text:
-                c_w = wcwidth(c)
+                c_w = char_width(c)
                 if c_w == -1:
                     continue
                 if w_remaining >= c_w:
@@ -435,6 +870,12 @@ def setup_curses_colour_pairs():
     curses.init_pair(Style.HL_ERROR, p.BRIGHT_WHITE, p.RED)
 
     curses.init_pair(Style.HL_KEYWORD, p.BRIGHT_WHITE, p.BLUE)
+    curses.init_pair(Style.HL_COMMENT, p.BRIGHT_CYAN, p.BLUE)
+    curses.init_pair(Style.HL_STRING, p.BRIGHT_YELLOW, p.BLUE)
+    curses.init_pair(Style.HL_CONSTANT, p.BRIGHT_MAGENTA, p.BLUE)
+    curses.init_pair(Style.HL_TYPE, p.BRIGHT_GREEN, p.BLUE)
+    curses.init_pair(Style.HL_PREPROCESSOR, p.GREEN, p.BLUE)
+    curses.init_pair(Style.HL_SPECIAL, p.BRIGHT_RED, p.BLUE)
 
 def style_attr(style):
     """Convert a style to a curses attribute value."""
@@ -1,7 +1,41 @@
+import collections
 import curses
-import queue
+import heapq
+import itertools
+from math import ceil
+import sys
 import time
 
+# Sequences which terminals in bracketed paste mode send around pasted text
+PASTE_START = '\x1b[200~'
+PASTE_END = '\x1b[201~'
+
+# Control sequences enabling and disabling bracketed paste mode
+BRACKETED_PASTE_ON = '\x1b[?2004h'
+BRACKETED_PASTE_OFF = '\x1b[?2004l'
+
+# How long, in milliseconds, to wait for the rest of a paste before giving up
+PASTE_TIMEOUT = 1000
+
+# Default maximum number of times per second the screen is drawn
+MAX_FRAME_RATE = 60
+
+class Callback:
+    """A callable scheduled by Application.add_timer() or add_idle(). It is
+    called at most once. Pending is True until it has been called or
+    cancelled.
+
+    """
+    __slots__ = ('callback', 'pending')
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.pending = True
+
+    def cancel(self):
+        """Prevent the callable being called if it has not been already."""
+        self.pending = False
+
 class Application:
     def __init__(self):
         # The current curses screen and its size
@@ -11,8 +45,25 @@ class Application:
         # A flag indicating if the application should exit
         self._should_exit = False
 
-        # A queue of timers in for form of (deadline, callable) tuples
-        self._timer_queue = queue.PriorityQueue()
+        # A heap of timers in the form of (deadline, sequence number, Callback)
+        # tuples. Sequence numbers order timers with the same deadline by when
+        # they were added. Cancelled timers are discarded as they are reached.
+        self._timers = []
+        self._timer_sequence = itertools.count()
+
+        # Callbacks to be called once there is no pending input
+        self._idle_callbacks = collections.deque()
+
+        # Input which has been read from curses but not yet processed
+        self._pending_input = collections.deque()
+
+        # The maximum number of frames drawn per second or None if unlimited
+        self.max_frame_rate = MAX_FRAME_RATE
+
+        # Whether a redraw has been requested and the earliest time at which
+        # the next frame may be drawn.
+        self._redraw_needed = False
+        self._next_frame_time = 0
 
     def run(self):
         curses.wrapper(self._curses_main)
@@ -25,6 +76,14 @@ class Application:
         # Ensure the terminal is in "raw" mode and set up the colour palette
         curses.raw()
 
+        # Ask the terminal to mark pasted text
+        _write_terminal(BRACKETED_PASTE_ON)
+        try:
+            self._event_loop(screen)
+        finally:
+            _write_terminal(BRACKETED_PASTE_OFF)
+
+    def _event_loop(self, screen):
         # Record the current curses screen and synthesize a redraw event
         self.screen = screen
         self.n_lines, self.n_cols = self.screen.getmaxyx()
@@ -35,39 +94,190 @@ class Application:
 
         # Start event loop
         while not self._should_exit:
-            # When is the next timer deadline?
-            try:
-                deadline, timer_cb = self._timer_queue.get(False)
-                now = time.monotonic()
-                self.screen.timeout(max(0, int(1e3 * (deadline-now))))
-            except queue.Empty:
-                deadline, timer_cb = -1, None
-                self.screen.timeout(-1)
-
-            # Get next keypress
-            try:
-                ch = screen.get_wch()
-            except curses.error:
-                # timeout
-                ch = None
-
-            # Call timer if we timed out
-            if ch is None and timer_cb is not None:
-                timer_cb()
-            elif timer_cb is not None:
-                # otherwise, put back on queue for next time
-                self._timer_queue.put((deadline, timer_cb))
-
-            # Process input
-            if ch == curses.KEY_RESIZE:
-                self.n_lines, self.n_cols = self.screen.getmaxyx()
-                self.resize()
-            elif ch is not None:
-                self.key_press(ch)
+            # Wait for input, the next timer or the next frame. Idle callbacks
+            # only wait for input which is already available.
+            self.screen.timeout(self._wait_time(self._next_deadline()))
+            ch = self._get_input()
+            had_input = ch is not None
+
+            # Process the input along with all other input which is already
+            # available so that a burst of key presses results in one frame.
+            # Stop early if this takes longer than a frame. With no frame rate
+            # limit, all available input is processed.
+            interval = self._frame_interval()
+            batch_end = time.monotonic() + interval
+            while ch is not None and not self._should_exit:
+                self._process_input(ch)
+                if interval and time.monotonic() >= batch_end:
+                    break
+                self.screen.timeout(0)
+                ch = self._get_input()
+
+            # Idle callbacks wait for an iteration without input so that the
+            # frame showing the effect of input is not delayed by them.
+            self._run_timers()
+            if not had_input and not self._should_exit:
+                self._run_idle_callbacks()
+
+            # Draw a frame if one is needed and permitted
+            now = time.monotonic()
+            if self._redraw_needed and now >= self._next_frame_time:
+                self._redraw_needed = False
+                self._next_frame_time = now + self._frame_interval()
+                self.draw()
+
+    def _process_input(self, ch):
+        if ch == curses.KEY_RESIZE:
+            self.n_lines, self.n_cols = self.screen.getmaxyx()
+            self.resize()
+        elif ch == PASTE_START[0] and self._match_input(PASTE_START[1:]):
+            self.paste(self._read_paste())
+        else:
+            self.key_press(ch)
+
+    def _frame_interval(self):
+        """Return the minimum time in seconds between frames."""
+        if not self.max_frame_rate:
+            return 0
+        return 1 / self.max_frame_rate
+
+    def _next_deadline(self):
+        """Return the deadline of the next timer which has not been cancelled or
+        None if there is no such timer.
+
+        """
+        timers = self._timers
+        while len(timers) > 0 and not timers[0][2].pending:
+            heapq.heappop(timers)
+        return timers[0][0] if len(timers) > 0 else None
+
+    def _run_timers(self):
+        """Call every timer whose deadline has passed. Timers added by those
+        called wait for the next call even if they are already due.
+
+        """
+        timers = self._timers
+        now = time.monotonic()
+        last_sequence = next(self._timer_sequence)
+        while len(timers) > 0 and timers[0][0] <= now and (
+                timers[0][1] < last_sequence) and not self._should_exit:
+            _, _, timer = heapq.heappop(timers)
+            if timer.pending:
+                timer.pending = False
+                timer.callback()
+
+    def _run_idle_callbacks(self):
+        """Call the idle callbacks which were added before this call."""
+        callbacks = self._idle_callbacks
+        for _ in range(len(callbacks)):
+            if self._should_exit:
+                break
+            idle = callbacks.popleft()
+            if idle.pending:
+                idle.pending = False
+                idle.callback()
+
+    def _wait_time(self, deadline):
+        """Return the curses input timeout in milliseconds given the next timer
+        deadline, which may be None, and any pending redraw or idle callbacks.
+
+        """
+        if len(self._idle_callbacks) > 0:
+            return 0
+        if self._redraw_needed:
+            if deadline is None:
+                deadline = self._next_frame_time
+            else:
+                deadline = min(deadline, self._next_frame_time)
+        if deadline is None:
+            return -1
+        return max(0, int(ceil(1e3 * (deadline - time.monotonic()))))
+
+    def _get_input(self):
+        """Return the next pending input or read one from curses. Returns None
+        if the read timed out.
+
+        """
+        if len(self._pending_input) > 0:
+            return self._pending_input.popleft()
+        try:
+            return self.screen.get_wch()
+        except curses.error:
+            # timeout
+            return None
+
+    def _match_input(self, expected):
+        """Return True if the input which is immediately available matches
+        expected and consume it. Otherwise leave the input to be processed as
+        usual.
+
+        """
+        self.screen.timeout(0)
+        read = []
+        for expected_ch in expected:
+            ch = self._get_input()
+            if ch is None:
+                break
+            read.append(ch)
+            if ch != expected_ch:
+                break
+        else:
+            return True
+
+        self._pending_input.extendleft(reversed(read))
+        return False
+
+    def _read_paste(self):
+        """Read pasted text up to the end of paste marker."""
+        # Key sequences within pasted text should be taken literally
+        self.screen.keypad(0)
+        self.screen.timeout(PASTE_TIMEOUT)
+        try:
+            chars = []
+            while True:
+                ch = self._get_input()
+                if ch is None:
+                    break
+                if isinstance(ch, int):
+                    continue
+                chars.append(ch)
+                if ch == PASTE_END[-1] and ''.join(
+                        chars[-len(PASTE_END):]) == PASTE_END:
+                    del chars[-len(PASTE_END):]
+                    break
+        finally:
+            self.screen.keypad(1)
+        return ''.join(chars)
 
     def add_timer(self, delay, cb):
+        """Arrange for cb to be called once at least delay seconds from now.
+        Timers which are due are called in order of deadline and then of
+        addition. Return a Callback which may be used to cancel the timer.
+
+        """
         assert delay >= 0
-        self._timer_queue.put((time.monotonic() + delay, cb))
+        timer = Callback(cb)
+        heapq.heappush(self._timers, (
+            time.monotonic() + delay, next(self._timer_sequence), timer))
+        return timer
+
+    def add_idle(self, cb):
+        """Arrange for cb to be called once when there is no input waiting to be
+        processed. Idle callbacks are called in the order they were added.
+        Return a Callback which may be used to cancel the call.
+
+        """
+        idle = Callback(cb)
+        self._idle_callbacks.append(idle)
+        return idle
+
+    def redraw(self):
+        """Request that the screen be redrawn. The draw() handler is called
+        once all available input has been processed and no more often than
+        max_frame_rate times per second.
+
+        """
+        self._redraw_needed = True
 
     def quit(self):
         """Signal that the application should exit."""
@@ -84,3 +294,20 @@ class Application:
     def key_press(self, ch):
         """Called when a string or integer key press is available."""
         pass
+
+    def draw(self):
+        """Called when the screen should be drawn."""
+        pass
+
+    def paste(self, text):
+        """Called when text has been pasted into the terminal. By default, each
+        character is treated as a key press.
+
+        """
+        for ch in text:
+            self.key_press(ch)
+
+def _write_terminal(sequence):
+    """Write a control sequence directly to the terminal."""
+    sys.stdout.write(sequence)
+    sys.stdout.flush()
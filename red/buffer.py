@@ -0,0 +1,429 @@
+"""
+A piece table used as the backing store for text documents.
+
+The document text is the concatenation of a sequence of "pieces", each of which
+is a slice of some immutable buffer. Edits never modify text in place: inserted
+text is appended to an "add" buffer and pieces are split and spliced around it.
+
+Every line in the document is terminated by a newline and so the number of
+lines is exactly the number of newlines. Pieces are located by line via a
+cumulative count of newlines which is searched with bisect.
+
+The original text may either be a string or a memory-mapped file. In the
+latter case, lines are decoded only when asked for and a line is copied into
+the add buffer ("materialised") only when it is edited.
+
+"""
+import bisect
+import collections
+import itertools
+import mmap
+import operator
+import os
+from array import array
+
+# A piece of the document. The text of the piece is buffer.slice(start, end) and
+# newlines is the number of newline characters within that range.
+Piece = collections.namedtuple('Piece', 'buffer start end newlines')
+
+# Once an add buffer grows beyond this many characters, a fresh one is started
+# so that appending to it remains cheap.
+ADD_BUFFER_SIZE = 1 << 16
+
+# Size, in bytes, of the chunks a mapped file is read in when building its
+# newline index or writing it out.
+MAPPED_CHUNK_SIZE = 1 << 24
+
+class TextBuffer:
+    """An append-only string along with a sorted index of the offsets of the
+    newline characters within it.
+
+    """
+    # Offsets are character indices and so text can be addressed directly
+    is_mapped = False
+
+    # The line ending the text was read with
+    newline = '\n'
+
+    def __init__(self, text=''):
+        self.text = ''
+        self.newlines = array('q')
+        self.append(text)
+
+    def __len__(self):
+        return len(self.text)
+
+    def append(self, text):
+        """Append text to the buffer returning the offset it was appended at."""
+        offset = len(self.text)
+        self.text += text
+        self.newlines.extend(_find_newlines(text, offset))
+        return offset
+
+    def slice(self, start, end):
+        """Return the text between two offsets."""
+        return self.text[start:end]
+
+    def iter_slices(self, start, end):
+        """Yield the text between two offsets as a sequence of strings."""
+        yield self.text[start:end]
+
+    def iter_bytes(self, start, end, encoding, newline='\n'):
+        """Yield the text between two offsets encoded as a sequence of bytes
+        objects with each newline written as newline.
+
+        """
+        text = self.text[start:end]
+        if newline != '\n':
+            text = text.replace('\n', newline)
+        yield text.encode(encoding)
+
+    def count_newlines(self, start, end):
+        """Return the number of newlines in text[start:end]."""
+        nl = self.newlines
+        return bisect.bisect_left(nl, end) - bisect.bisect_left(nl, start)
+
+    def find_newline(self, start, end):
+        """Return the offset of the first newline in text[start:end] or -1 if
+        there is none.
+
+        """
+        idx = bisect.bisect_left(self.newlines, start)
+        if idx < len(self.newlines) and self.newlines[idx] < end:
+            return self.newlines[idx]
+        return -1
+
+    def nth_newline(self, start, n):
+        """Return the offset of the n-th (0-based) newline at or after start."""
+        return self.newlines[bisect.bisect_left(self.newlines, start) + n]
+
+class MappedBuffer(TextBuffer):
+    """A read-only buffer backed by a memory-mapped file. Offsets are byte
+    offsets into the file and text is decoded only when sliced. Carriage returns
+    preceding newlines are dropped. If the file does not end with a newline,
+    one is implied just past its end. The line ending of the first line is
+    taken to be that of the file.
+
+    """
+    is_mapped = True
+
+    def __init__(self, file_object, encoding='utf-8'):
+        # pylint: disable=super-init-not-called
+        self.encoding = encoding
+
+        size = os.fstat(file_object.fileno()).st_size
+        if size > 0:
+            self._map = mmap.mmap(
+                file_object.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b''
+
+        # Use 32-bit offsets where possible to halve the size of the index
+        self.newlines = array('I' if size < (1 << 32) else 'q')
+        for base in range(0, size, MAPPED_CHUNK_SIZE):
+            chunk = self._map[base:base + MAPPED_CHUNK_SIZE]
+            self.newlines.extend(_find_newlines(chunk, base))
+
+        first_nl = self.newlines[0] if len(self.newlines) > 0 else 0
+        self.newline = '\n'
+        if first_nl > 0 and self._map[first_nl-1] == ord('\r'):
+            self.newline = '\r\n'
+
+        self._size = size
+        if size > 0 and self._map[size-1] != ord('\n'):
+            self.newlines.append(size)
+            self._size += 1
+
+    def __len__(self):
+        return self._size
+
+    def append(self, text):
+        raise TypeError('mapped buffers are read-only')
+
+    def slice(self, start, end):
+        text = self._map[start:end].decode(self.encoding, 'replace')
+        if end > len(self._map):
+            text += '\n'
+        elif end < len(self._map) and self._map[end] == ord('\n'):
+            if text.endswith('\r'):
+                text = text[:-1]
+        return text.replace('\r\n', '\n')
+
+    def iter_slices(self, start, end):
+        # Slices are split just after a newline so that neither multi-byte
+        # characters nor line endings are broken.
+        while start < end:
+            stop = start + MAPPED_CHUNK_SIZE
+            if stop < end:
+                nl = self.find_newline(stop, end)
+                stop = end if nl == -1 else nl + 1
+            stop = min(stop, end)
+            yield self.slice(start, stop)
+            start = stop
+
+    def iter_bytes(self, start, end, encoding, newline='\n'):
+        """Yield the bytes of the file between two offsets as they are, without
+        decoding them, followed by the implied newline if the range includes
+        it.
+
+        """
+        size = len(self._map)
+        for base in range(start, min(end, size), MAPPED_CHUNK_SIZE):
+            yield self._map[base:min(base + MAPPED_CHUNK_SIZE, end, size)]
+        if end > size:
+            yield newline.encode(encoding)
+
+class PieceTable:
+    """A line-oriented piece table. Locations are given as 0-based (line,
+    char) pairs. Every line, including the last, is terminated by a newline
+    which is not included in the text returned for that line.
+
+    The original text may be passed as a string or as a buffer.
+
+    """
+    def __init__(self, original=''):
+        self._pieces = []
+
+        # Number of newlines in each piece and the cumulative number of newlines
+        # before each piece. The latter is rebuilt lazily from _prefix_valid.
+        self._piece_newlines = []
+        self._newline_prefix = [0]
+        self._prefix_valid = 0
+
+        self._add = TextBuffer()
+
+        if isinstance(original, str):
+            original = TextBuffer(original)
+        self._is_mapped = original.is_mapped
+        self._newline = original.newline
+        if len(original) > 0:
+            self._splice(0, 0, [
+                Piece(original, 0, len(original), len(original.newlines))])
+
+    @property
+    def line_count(self):
+        return self._prefix()[-1]
+
+    def get_line(self, line):
+        """Return the text of a line without its trailing newline."""
+        if line < 0 or line >= self.line_count:
+            raise IndexError('line index out of range')
+
+        idx, offset = self._locate_line(line)
+        parts = []
+        while idx < len(self._pieces):
+            piece = self._pieces[idx]
+            nl = piece.buffer.find_newline(offset, piece.end)
+            if nl != -1:
+                parts.append(piece.buffer.slice(offset, nl))
+                break
+            parts.append(piece.buffer.slice(offset, piece.end))
+            idx += 1
+            if idx < len(self._pieces):
+                offset = self._pieces[idx].start
+        return ''.join(parts)
+
+    def iter_text(self):
+        """Yield the document text as a sequence of strings."""
+        for piece in self._pieces:
+            yield from piece.buffer.iter_slices(piece.start, piece.end)
+
+    def iter_bytes(self, encoding):
+        """Yield the document text encoded as a sequence of bytes objects. Text
+        which is still held in a memory-mapped file is yielded as the bytes it
+        was read from and so keeps its line endings and any bytes which could
+        not be decoded. Other newlines are written as the original text's line
+        ending.
+
+        """
+        for piece in self._pieces:
+            yield from piece.buffer.iter_bytes(
+                piece.start, piece.end, encoding, self._newline)
+
+    def insert(self, line, char, text):
+        """Insert text at a given location. Inserting at line == line_count
+        appends to the document.
+
+        """
+        if len(text) == 0:
+            return
+
+        self._materialise(line)
+        idx = self._split(*self._locate(line, char))
+
+        # Common case: text is being typed at the end of the previous insertion
+        # and so the previous piece can simply be extended.
+        add = self._add
+        if idx > 0 and len(add) < ADD_BUFFER_SIZE:
+            prev = self._pieces[idx-1]
+            if prev.buffer is add and prev.end == len(add):
+                add.append(text)
+                self._splice(idx-1, idx, [Piece(
+                    add, prev.start, len(add),
+                    prev.newlines + add.count_newlines(prev.end, len(add)))])
+                return
+
+        if len(add) >= ADD_BUFFER_SIZE:
+            add = self._add = TextBuffer()
+        start = add.append(text)
+        self._splice(idx, idx, [Piece(
+            add, start, len(add), add.count_newlines(start, len(add)))])
+
+    def delete(self, line, char, length):
+        """Delete length characters starting at a given location. Newlines
+        count as one character.
+
+        """
+        if length <= 0:
+            return
+
+        if self._is_mapped:
+            # Materialise every line touched by the deletion including the
+            # one which will be joined to the end of it.
+            self._materialise(line)
+            last, remaining = line, length - (len(self.get_line(line)) + 1 - char)
+            while remaining >= 0 and last + 1 < self.line_count:
+                last += 1
+                self._materialise(last)
+                remaining -= len(self.get_line(last)) + 1
+
+        start_idx = self._split(*self._locate(line, char))
+
+        # Walk forward to find the piece containing the end of the deletion.
+        end_idx, remaining = start_idx, length
+        while end_idx < len(self._pieces):
+            piece = self._pieces[end_idx]
+            if remaining < piece.end - piece.start:
+                break
+            remaining -= piece.end - piece.start
+            end_idx += 1
+
+        if end_idx < len(self._pieces) and remaining > 0:
+            end_idx = self._split(
+                end_idx, self._pieces[end_idx].start + remaining)
+
+        self._splice(start_idx, end_idx, [])
+
+    ### Internal
+
+    def _prefix(self):
+        """Return the cumulative newline count list, rebuilding it if
+        necessary.
+
+        """
+        valid = self._prefix_valid
+        if valid < len(self._pieces):
+            prefix = self._newline_prefix
+            del prefix[valid+1:]
+            prefix.extend(itertools.accumulate(
+                self._piece_newlines[valid:], initial=prefix[valid]))
+            del prefix[valid+1]
+            self._prefix_valid = len(self._pieces)
+        return self._newline_prefix
+
+    def _splice(self, start, end, pieces):
+        """Replace self._pieces[start:end] with pieces."""
+        self._pieces[start:end] = pieces
+        self._piece_newlines[start:end] = [p.newlines for p in pieces]
+        self._prefix_valid = min(self._prefix_valid, start)
+        if self._prefix_valid == len(self._pieces):
+            del self._newline_prefix[self._prefix_valid+1:]
+
+    def _locate_line(self, line):
+        """Return (piece index, buffer offset) for the start of a line. If the
+        line starts at the end of the document, the piece index is
+        len(self._pieces).
+
+        """
+        if line == 0:
+            idx = 0
+        else:
+            # Find the piece containing the newline ending the previous line.
+            prefix = self._prefix()
+            idx = bisect.bisect_left(prefix, line) - 1
+            piece = self._pieces[idx]
+            offset = piece.buffer.nth_newline(
+                piece.start, line - prefix[idx] - 1) + 1
+            if offset < piece.end:
+                return idx, offset
+            idx += 1
+
+        if idx < len(self._pieces):
+            return idx, self._pieces[idx].start
+        return idx, None
+
+    def _locate(self, line, char):
+        """Return (piece index, buffer offset) for a location."""
+        idx, offset = self._locate_line(line)
+        while idx < len(self._pieces):
+            piece = self._pieces[idx]
+            if char < piece.end - offset:
+                return idx, offset + char
+            char -= piece.end - offset
+            idx += 1
+            if idx < len(self._pieces):
+                offset = self._pieces[idx].start
+        if char > 0:
+            raise IndexError('location past end of document')
+        return idx, None
+
+    def _materialise(self, line):
+        """Ensure that a line is held in a buffer which may be addressed by
+        character by copying it into the add buffer if necessary.
+
+        """
+        if not self._is_mapped or line >= self.line_count:
+            return
+
+        idx, offset = self._locate_line(line)
+        piece = self._pieces[idx]
+        if not piece.buffer.is_mapped:
+            return
+
+        # Mapped pieces always hold whole lines
+        end = piece.buffer.find_newline(offset, piece.end) + 1
+        text = piece.buffer.slice(offset, end)
+        start_idx = self._split(idx, offset)
+        end_idx = self._split(start_idx, end)
+
+        if len(self._add) >= ADD_BUFFER_SIZE:
+            self._add = TextBuffer()
+        start = self._add.append(text)
+        self._splice(start_idx, end_idx, [
+            Piece(self._add, start, len(self._add), 1)])
+
+    def _split(self, idx, offset):
+        """Ensure that a piece starts at buffer offset within piece idx and
+        return its index.
+
+        """
+        if idx == len(self._pieces):
+            return idx
+        piece = self._pieces[idx]
+        if offset == piece.start:
+            return idx
+        if offset == piece.end:
+            return idx + 1
+
+        buf = piece.buffer
+        left_newlines = buf.count_newlines(piece.start, offset)
+        self._splice(idx, idx+1, [
+            Piece(buf, piece.start, offset, left_newlines),
+            Piece(buf, offset, piece.end, piece.newlines - left_newlines),
+        ])
+        return idx + 1
+
+def _find_newlines(text, base=0):
+    """Return an iterable of the offsets of each newline in text added to base.
+    The text may be a str or bytes.
+
+    """
+    # Offsets are a cumulative sum of the line lengths. This keeps the per-line
+    # work in C which matters when indexing multi-gigabyte files.
+    parts = text.split('\n' if isinstance(text, str) else b'\n')
+    parts.pop()
+    offsets = itertools.accumulate(
+        map(operator.add, map(len, parts), itertools.repeat(1)),
+        initial=base - 1)
+    next(offsets)
+    return offsets
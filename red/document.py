@@ -1,9 +1,17 @@
+import bisect
 import collections
+import collections.abc
 import enum
+import functools
+import itertools
+import re
+import sys
+import time
+from array import array
 
-from wcwidth import wcwidth, wcswidth
-
-from .syntax import lex, start_lang
+from .buffer import MappedBuffer, PieceTable
+from .language import LANGUAGE_MANAGER, lex, start_lang
+from .width import char_width, char_widths, segment, NON_PRINTABLE
 
 class Style(enum.IntEnum):
     """Styles for character cells."""
@@ -21,6 +29,12 @@ class Style(enum.IntEnum):
     HL_ERROR = 14
 
     HL_KEYWORD = 15
+    HL_COMMENT = 16
+    HL_STRING = 17
+    HL_CONSTANT = 18
+    HL_TYPE = 19
+    HL_PREPROCESSOR = 20
+    HL_SPECIAL = 21
 
 # The location of a cell within a window or on-screen. A cell is located by the
 # 0-based row and column indices.
@@ -37,35 +51,345 @@ WCHAR_RIGHT = Cell('<', Style.WCHAR_RIGHT)
 
 TAB_SIZE = 8
 
+# Approximate memory budget, in bytes, for the TextLine instances a document
+# keeps cached. Least recently used lines are evicted once it is exceeded.
+LINE_CACHE_BUDGET = 64 * 1024 * 1024
+
+# Rough number of bytes needed to hold the rendered form of one character.
+RENDERED_CHAR_SIZE = 8
+
+# Lines longer than this many characters are neither highlighted nor rendered
+# in full. Their cells are built a chunk of about LINE_CHUNK_SIZE characters at
+# a time as they are needed and at most LINE_CHUNK_CACHE_SIZE rendered chunks
+# are kept for each line. See ChunkedTextLine.
+LONG_LINE_LENGTH = 16 * 1024
+LINE_CHUNK_SIZE = 4 * 1024
+LINE_CHUNK_CACHE_SIZE = 8
+
+# Lines per block of a WrapIndex. Blocks are split once they have more than
+# twice this many lines.
+WRAP_BLOCK_SIZE = 512
+
+# The Style used for the default styles defined by def.lang. Styles defined by
+# other languages map on to these.
+DEFAULT_LEX_STYLES = {
+    'def:comment': Style.HL_COMMENT,
+    'def:doc-comment-element': Style.HL_COMMENT,
+    'def:note': Style.HL_SPECIAL,
+    'def:string': Style.HL_STRING,
+    'def:character': Style.HL_STRING,
+    'def:special-char': Style.HL_SPECIAL,
+    'def:constant': Style.HL_CONSTANT,
+    'def:statement': Style.HL_KEYWORD,
+    'def:type': Style.HL_TYPE,
+    'def:preprocessor': Style.HL_PREPROCESSOR,
+    'def:error': Style.HL_ERROR,
+}
+
+def text_width(text, col=0):
+    """Return the width in cells of text once rendered by TextLine. This is
+    cheaper than rendering since no lexing or cell construction is done. Col is
+    the column the text starts at, which determines the width of tabs.
+
+    """
+    tab_offset = col % TAB_SIZE
+    if text.isascii():
+        # Tabs and printable characters are the only ASCII characters which
+        # occupy cells.
+        if text.isprintable():
+            return len(text)
+        if text.replace('\t', '').isprintable():
+            return len((' ' * tab_offset + text).expandtabs(TAB_SIZE)) - (
+                tab_offset)
+
+    if '\t' not in text:
+        return sum(char_widths(text).replace(bytes([NON_PRINTABLE]), b''))
+
+    x = tab_offset
+    for ch, w in zip(text, char_widths(text)):
+        if ch == '\t':
+            x += TAB_SIZE - (x % TAB_SIZE)
+        elif w != NON_PRINTABLE:
+            x += w
+    return x - tab_offset
+
 class TextDocument:
-    def __init__(self):
-        self.lines = []
+    def __init__(self, line_cache_budget=LINE_CACHE_BUDGET):
+        self._buffer = PieceTable()
         self._cursor = DocumentLocation(0, 0)
-        self._max_col = 0
+
+        # The encoding of the file the document was read from if it was read
+        # in binary mode. See write_to_binary_file().
+        self._encoding = None
+
+        # The width in cells of each line
+        self._line_widths = LineWidths()
+
+        # An LRU cache of TextLine instances, the total estimated size of the
+        # lines within it and a sequence view over them. Lines are cached under
+        # a key which is given to each line when it is first rendered and kept
+        # in _line_keys so that lines moved by an edit need not be cached
+        # again.
+        self.line_cache_budget = line_cache_budget
+        self._line_cache = collections.OrderedDict()
+        self._line_cache_size = 0
+        self._line_keys = []
+        self._next_line_key = itertools.count()
+        self._lines = TextLines(self)
+
+        # Callables which are passed (first, n_removed, n_inserted) after lines
+        # in the document have changed. See _lines_changed().
+        self.change_listeners = []
+
+        # Callables which are passed (first, n_lines) after the highlighting of
+        # lines has changed but their text has not.
+        self.style_listeners = []
+
+        # Lexer state at the start and end of each line. The end state of a
+        # line is only valid if its start state matches the end state of the
+        # line before. States are known to be valid for lines before
+        # _lexed_lines. Lines from then until _lexed_to were highlighted before
+        # the last edits and each starts in the state the line before ends in,
+        # so once a line ends as it did before they are all valid too. Lines
+        # are lexed by highlight(), which keeps the spans it finds for each
+        # line to be rendered with. Until a line has been lexed it is rendered
+        # with no highlighting. The root state is None if the document's
+        # language is not known in which case it is not highlighted.
+        self._language_id = None
+        self._lex_root = None
+        self._lex_starts = []
+        self._lex_ends = []
+        self._lex_spans = []
+        self._lexed_lines = 0
+        self._lexed_to = 0
 
     def read_from_file(self, file_object):
         self.clear()
-        for line in file_object:
-            line = line.rstrip('\n\r')
-            self.append_line(line)
+        lines = [line.rstrip('\n\r') for line in file_object]
+        self._buffer = PieceTable(''.join(line + '\n' for line in lines))
+        self._line_widths.reset(map(text_width, lines))
+        self._guess_language(file_object)
+
+    def read_from_mapped_file(self, file_object, encoding='utf-8'):
+        """Read the document from a file opened in binary mode by memory-mapping
+        it. Lines are decoded lazily as they are needed.
+
+        """
+        self.clear()
+        self._buffer = PieceTable(MappedBuffer(file_object, encoding))
+        self._encoding = encoding
+
+        # Lines are measured as they are decoded
+        self._line_widths.reset_unknown(self._buffer.line_count)
+        self._guess_language(file_object)
 
     def write_to_file(self, file_object):
-        for line in self.lines:
-            file_object.write(line.text)
-            file_object.write('\n')
+        # Each line in the buffer is already terminated by a newline
+        for text in self._buffer.iter_text():
+            file_object.write(text)
+
+    def write_to_binary_file(self, file_object):
+        """Write the document to a file opened in binary mode in the encoding it
+        was read with, or UTF-8 if it was read as text. Lines which have not
+        been edited since the document was read from a memory-mapped file are
+        written as the bytes they were read from and so keep their line endings
+        and any bytes which could not be decoded.
+
+        """
+        encoding = self._encoding if self._encoding is not None else 'utf-8'
+        for data in self._buffer.iter_bytes(encoding):
+            file_object.write(data)
+
+    @property
+    def encoding(self):
+        """The encoding of the file the document was read from if it was read
+        in binary mode by read_from_mapped_file(). Otherwise None.
+
+        """
+        return self._encoding
+
+    @property
+    def lines(self):
+        """A sequence of TextLine instances, one for each line in the
+        document.
+
+        """
+        return self._lines
+
+    def get_line(self, row_idx):
+        """Return the TextLine for a given line index. Lines are rendered
+        lazily and so this is cheap until the line's cells are needed.
+
+        """
+        spans = self._lex_spans[row_idx]
+
+        key = self._line_keys[row_idx]
+        if key is None:
+            key = self._line_keys[row_idx] = next(self._next_line_key)
+
+        cache = self._line_cache
+        line = cache.get(key)
+        if line is not None and line.spans is spans:
+            cache.move_to_end(key)
+            return line
+        if line is not None:
+            # The line is highlighted differently now
+            del cache[key]
+            self._line_cache_size -= line.size_estimate
+
+        line = make_text_line(self._buffer.get_line(row_idx), spans)
+        if self._line_widths[row_idx] is None:
+            self._line_widths[row_idx] = (
+                line.width if isinstance(line, ChunkedTextLine)
+                else text_width(line.text))
+        cache[key] = line
+        self._line_cache_size += line.size_estimate
+
+        # Evict least recently used lines, always keeping the new one
+        while self._line_cache_size > self.line_cache_budget and len(cache) > 1:
+            _, evicted = cache.popitem(last=False)
+            self._line_cache_size -= evicted.size_estimate
+
+        return line
+
+    @property
+    def language_id(self):
+        """The id of the language the document is highlighted as or None if it
+        is not highlighted. Setting it highlights the document from scratch.
+
+        """
+        return self._language_id
+
+    @language_id.setter
+    def language_id(self, lang_id):
+        self._language_id = lang_id
+        self._lex_root = start_lang(lang_id) if lang_id is not None else None
+        self._reset_line_cache()
+        self._reset_lex_states()
+        self._notify_styles(0, self.max_row)
+
+    @property
+    def highlighted_lines(self):
+        """The number of lines from the start of the document whose
+        highlighting is known to be up to date.
+
+        """
+        if self._lex_root is None:
+            return self.max_row
+        return self._lexed_lines
+
+    def highlight(self, row_idx, deadline=None):
+        """Bring the highlighting of lines before row_idx up to date, giving up
+        once time.monotonic() passes deadline if it is not None. Return True if
+        all of those lines are now up to date.
+
+        Lines are only lexed again if their start state has changed and, once
+        a line ends in the state it did before, the lines after it which were
+        already highlighted are not visited. Listeners are told of lines whose
+        spans have changed as a result.
+
+        """
+        if self._lex_root is None:
+            return True
+
+        starts, ends = self._lex_starts, self._lex_ends
+        row_idx = min(row_idx, len(ends))
+        while self._lexed_lines < row_idx:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+            idx = self._lexed_lines
+            start = ends[idx-1] if idx > 0 else self._lex_root
+            if starts[idx] != start:
+                end = self._lex_line(idx, start)
+                if end != ends[idx]:
+                    ends[idx] = end
+                    self._lexed_lines = idx + 1
+                    self._lexed_to = max(self._lexed_to, idx + 1)
+                    continue
+
+            # The line ends as it did before and so the lines after it which
+            # were highlighted before are still up to date
+            self._lexed_lines = max(idx + 1, self._lexed_to)
+            self._lexed_to = self._lexed_lines
+
+        return True
+
+    def highlight_ahead(self, first, end, deadline=None):
+        """Lex the lines from first up to end which have not been lexed without
+        waiting for the lines before them to be highlighted, giving up once
+        time.monotonic() passes deadline if it is not None. Return True if all
+        of those lines have now been lexed.
+
+        Each line is lexed from the nearest state known for the lines before
+        it. That state is a guess and highlight() lexes the line again when it
+        reaches it if the guess was wrong. Lines highlighted before the last
+        edits are left for highlight() to check.
+
+        """
+        if self._lex_root is None:
+            return True
+
+        starts, ends = self._lex_starts, self._lex_ends
+        first = max(first, self._lexed_lines, self._lexed_to)
+        for idx in range(first, min(end, len(ends))):
+            if starts[idx] is not None:
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+            prev_idx = idx - 1
+            while prev_idx >= 0 and ends[prev_idx] is None:
+                prev_idx -= 1
+            start = ends[prev_idx] if prev_idx >= 0 else self._lex_root
+            ends[idx] = self._lex_line(idx, start)
+
+        return True
+
+    def needs_highlight(self, first, end):
+        """Return True if any line from first up to end has yet to be lexed,
+        either by highlight() or highlight_ahead().
+
+        """
+        if self._lex_root is None:
+            return False
+        starts = self._lex_starts
+        first, end = max(first, self._lexed_lines), min(end, len(starts))
+        return any(starts[idx] is None for idx in range(first, end))
 
     def get_cells_for_row(self, row_idx):
         if row_idx < 0 or row_idx >= self.max_row:
             return None
         return self.lines[row_idx].cells
 
+    def get_regions_for_row(self, row_idx, col, n_cols):
+        """Return n_cols cells starting at column col of a row as a list of
+        (text, style) pairs. See TextLine.get_regions(). Returns None if the row
+        is outside of the document.
+
+        """
+        if row_idx < 0 or row_idx >= self.max_row:
+            return None
+        return self.lines[row_idx].get_regions(col, col + n_cols)
+
     @property
     def max_row(self):
-        return len(self.lines)
+        return self._buffer.line_count
+
+    def line_width(self, row_idx):
+        """Return the width of a line in cells, measuring it if need be."""
+        width = self._line_widths[row_idx]
+        if width is None:
+            width = self.get_line(row_idx).width
+        return width
 
     @property
     def max_col(self):
-        return self._max_col
+        """The width in cells of the widest line. For memory-mapped documents,
+        only lines which have been decoded are considered.
+
+        """
+        return self._line_widths.max
 
     @property
     def cursor(self):
@@ -139,50 +463,79 @@ class TextDocument:
         self._cursor = DocumentLocation(row, index)
 
     def delete_character(self):
-        if self.cursor.line == len(self.lines):
+        cr, ci = self.cursor
+        if cr == self.max_row:
             return
-        line = self.lines[self.cursor.line]
-        if self.cursor.char == len(line.text):
-            if self.cursor.line + 1 < len(self.lines):
-                # join lines
-                new_line = TextLine(
-                    line.text + self.lines[self.cursor.line+1].text)
-                self.lines[self.cursor.line:self.cursor.line+2] = [new_line]
+        line = self.lines[cr]
+        if ci == len(line.text):
+            if cr + 1 < self.max_row:
+                # join lines by deleting the newline
+                self._buffer.delete(cr, ci, 1)
+                self._lines_changed(cr, 2, 1)
         else:
-            new_line = TextLine(
-                line.text[:self.cursor.char] + line.text[self.cursor.char+1:])
-            self.lines[self.cursor.line] = new_line
+            self._buffer.delete(cr, ci, 1)
+            self._lines_changed(cr, 1, 1)
 
     def insert_character(self, ch):
+        cr, ci = self.cursor
         if ch in '\r\n':
             self.insert_newline()
-        elif self.cursor.line == len(self.lines):
+        elif cr == self.max_row:
             self.append_line(ch)
         else:
-            line = self.lines[self.cursor.line]
-            line.insert_character_at(self.cursor.char, ch)
-            self._max_col = max(self._max_col, len(line.cells))
+            self._buffer.insert(cr, ci, ch)
+            self._lines_changed(cr, 1, 1)
 
     def insert_newline(self):
-        if self.cursor.line == len(self.lines):
+        cr, ci = self.cursor
+        if cr == self.max_row:
             self.append_line('')
             return
 
         # Split current line at cursor
-        line = self.lines[self.cursor.line]
-        new_lines = [
-            TextLine(line.text[:self.cursor.char]),
-            TextLine(line.text[self.cursor.char:]),
-        ]
-        self.lines[self.cursor.line:self.cursor.line+1] = new_lines
+        self._buffer.insert(cr, ci, '\n')
+        self._lines_changed(cr, 1, 2)
+
+    def insert_text(self, location, text):
+        """Insert text, which may span many lines, at a DocumentLocation in a
+        single edit. Return the DocumentLocation just after the inserted text.
+
+        """
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        row, index = location
+        if len(text) == 0:
+            return DocumentLocation(row, index)
+
+        n_newlines = text.count('\n')
+        if n_newlines == 0:
+            end = DocumentLocation(row, index + len(text))
+        else:
+            end = DocumentLocation(
+                row + n_newlines, len(text) - text.rfind('\n') - 1)
+
+        if row == self.max_row:
+            # Every line in the document must end with a newline
+            if not text.endswith('\n'):
+                text += '\n'
+            self._buffer.insert(row, 0, text)
+            self._lines_changed(row, 0, text.count('\n'))
+        else:
+            self._buffer.insert(row, index, text)
+            self._lines_changed(row, 1, 1 + n_newlines)
+
+        return end
 
     def append_line(self, s):
-        row = TextLine(s)
-        self._max_col = max(self._max_col, len(row.cells))
-        self.lines.append(row)
+        row_idx = self.max_row
+        self._buffer.insert(row_idx, 0, s + '\n')
+        self._lines_changed(row_idx, 0, 1)
 
     def clear(self):
-        self.lines = []
+        self._buffer = PieceTable()
+        self._encoding = None
+        self._reset_line_cache()
+        self._line_widths.reset([])
+        self._reset_lex_states()
 
     def cell_to_cursor(self, cell_location):
         """Convert a CellLocation to the nearest DocumentLocation."""
@@ -199,84 +552,870 @@ class TextDocument:
         row = self.lines[y]
         return DocumentLocation(y, row.cell_to_char(x))
 
+    ### Internal
+
+    def _lines_changed(self, first, n_removed, n_inserted):
+        """Called after an edit has replaced n_removed lines starting at line
+        index first with n_inserted new lines.
+
+        """
+        delta = n_inserted - n_removed
+        keys = self._line_keys
+        for key in keys[first:first + n_removed]:
+            line = self._line_cache.pop(key, None)
+            if line is not None:
+                self._line_cache_size -= line.size_estimate
+        keys[first:first + n_removed] = [None] * n_inserted
+
+        self._line_widths.splice(first, n_removed, [
+            text_width(self._buffer.get_line(row_idx))
+            for row_idx in range(first, first + n_inserted)
+        ])
+
+        # The new lines must be lexed again. The last of them is given the end
+        # state the removed lines had so that, if lexing it gives the same
+        # state, the lines after it are known not to have changed.
+        ends = self._lex_ends
+        new_ends = [None] * n_inserted
+        if n_inserted > 0 and first + n_removed > 0:
+            new_ends[-1] = ends[first + n_removed - 1]
+        elif n_inserted > 0:
+            new_ends[-1] = self._lex_root
+        self._lex_starts[first:first + n_removed] = [None] * n_inserted
+        ends[first:first + n_removed] = new_ends
+        self._lex_spans[first:first + n_removed] = [None] * n_inserted
+
+        # Lines after the edit which start in the state the line before them
+        # ends in may be skipped once the new lines are lexed. The line
+        # highlighting was to resume at may not and so is never skipped.
+        # Lines highlighted before an earlier edit but after this one can no
+        # longer be reached.
+        if first + n_removed <= self._lexed_lines:
+            self._lexed_to = self._lexed_lines + delta
+        elif first <= self._lexed_lines and self._lexed_to > first + n_removed:
+            self._lexed_to += delta
+        else:
+            self._lexed_to = min(self._lexed_to, first)
+        self._lexed_lines = min(self._lexed_lines, first)
+
+        self._notify_change(first, n_removed, n_inserted)
+
+    def _notify_change(self, first, n_removed, n_inserted):
+        for listener in self.change_listeners:
+            listener(first, n_removed, n_inserted)
+
+    def _notify_styles(self, first, n_lines):
+        for listener in self.style_listeners:
+            listener(first, n_lines)
+
+    def _guess_language(self, file_object):
+        """Set the language from the name of the file being read, if it has
+        one.
+
+        """
+        filename = getattr(file_object, 'name', None)
+        self.language_id = LANGUAGE_MANAGER.guess_language(
+            filename if isinstance(filename, str) else None)
+
+    def _lex_line(self, idx, start):
+        """Lex a line from the state start, recording the start state and the
+        line's spans. Listeners are told if its spans have changed. Return the
+        state the line ends in.
+
+        """
+        # Long lines are not highlighted and leave the state as it was
+        text = self._buffer.get_line(idx)
+        spans, end = None, start
+        if len(text) <= LONG_LINE_LENGTH:
+            spans, end = lex(text, start)
+        self._lex_starts[idx] = start
+        if spans != self._lex_spans[idx]:
+            self._lex_spans[idx] = spans
+            self._notify_styles(idx, 1)
+        return end
+
+    def _reset_line_cache(self):
+        self._line_cache.clear()
+        self._line_cache_size = 0
+        self._line_keys = [None] * self._buffer.line_count
+
+    def _reset_lex_states(self):
+        self._lex_starts = [None] * self._buffer.line_count
+        self._lex_ends = [None] * self._buffer.line_count
+        self._lex_spans = [None] * self._buffer.line_count
+        self._lexed_lines = 0
+        self._lexed_to = 0
+
+class LineWidths:
+    """The width in cells of each line in a document. A histogram of widths is
+    maintained so that the maximum width is always available as lines are
+    changed, inserted and removed. A width may be None if the line has not yet
+    been measured. Such lines do not contribute to the maximum.
+
+    """
+    def __init__(self):
+        self._widths = array('i')
+
+        # Number of lines with each width and a sorted list of the widths which
+        # have a non-zero count.
+        self._counts = collections.Counter()
+        self._sorted = []
+
+    @property
+    def max(self):
+        return self._sorted[-1] if len(self._sorted) > 0 else 0
+
+    def __len__(self):
+        return len(self._widths)
+
+    def __getitem__(self, idx):
+        width = self._widths[idx]
+        return width if width >= 0 else None
+
+    def __setitem__(self, idx, width):
+        self.splice(idx, 1, [width])
+
+    def reset(self, widths):
+        """Replace all widths."""
+        self._widths = array('i', widths)
+        self._counts = collections.Counter(self._widths)
+        self._sorted = sorted(self._counts)
+
+    def reset_unknown(self, n_lines):
+        """Replace all widths with n_lines of unknown width."""
+        self.reset([])
+        self._widths = array('i', [-1]) * n_lines
+
+    def splice(self, first, n_removed, widths):
+        """Replace n_removed widths starting at first with new widths."""
+        for width in self._widths[first:first + n_removed]:
+            self._remove(width)
+        widths = array('i', (-1 if w is None else w for w in widths))
+        for width in widths:
+            self._add(width)
+        self._widths[first:first + n_removed] = widths
+
+    def _add(self, width):
+        if width < 0:
+            return
+        self._counts[width] += 1
+        if self._counts[width] == 1:
+            bisect.insort(self._sorted, width)
+
+    def _remove(self, width):
+        if width < 0:
+            return
+        self._counts[width] -= 1
+        if self._counts[width] == 0:
+            del self._counts[width]
+            del self._sorted[bisect.bisect_left(self._sorted, width)]
+
+class WrapIndex:
+    """Maps between the rows of a soft-wrapped view of a TextDocument and the
+    lines of the document. A line of width w cells is wrapped into w // width
+    + 1 rows of width cells each so that there is always a cell for the cursor
+    after its last character.
+
+    The number of rows each line has beyond its first is recorded in blocks of
+    about WRAP_BLOCK_SIZE lines. Fenwick trees over the blocks give the number
+    of lines and of extra rows before each block so that the row at which a
+    line starts and the line at a given row are found in O(log n) plus a scan
+    of one block. Inserting or removing lines changes only the blocks holding
+    them and the trees, which are small, are then rebuilt.
+
+    Lines are wrapped lazily: until wrap_line() is called for a line it is
+    counted as a single row. Edited lines and, when the width changes, every
+    line are unwrapped again.
+
+    """
+    def __init__(self, document, width):
+        self._document = document
+        self._width = max(1, width)
+        self._reset(document.max_row)
+
+    @property
+    def width(self):
+        return self._width
+
+    @width.setter
+    def width(self, width):
+        width = max(1, width)
+        if width != self._width:
+            self._width = width
+            self._reset(self.n_lines)
+
+    @property
+    def n_lines(self):
+        return _tree_prefix(self._line_tree, len(self._blocks))
+
+    @property
+    def n_rows(self):
+        """The total number of rows."""
+        return self.n_lines + _tree_prefix(self._extra_tree, len(self._blocks))
+
+    def line_rows(self, line_idx):
+        """Return the number of rows a line occupies."""
+        block_idx, offset = self._find_block(line_idx)
+        return self._blocks[block_idx][offset] + 1
+
+    def next_unwrapped(self, line_idx=0):
+        """Return the index of the first line at or after line_idx which has not
+        been wrapped or None if there is no such line.
+
+        """
+        block_idx, offset = self._find_block(line_idx)
+        line_idx -= offset
+        while block_idx < len(self._blocks):
+            found = self._wrapped[block_idx].find(0, offset)
+            if found >= 0:
+                return line_idx + found
+            line_idx += len(self._blocks[block_idx])
+            block_idx, offset = block_idx + 1, 0
+        return None
+
+    def wrap_line(self, line_idx):
+        """Wrap a line if it has not already been wrapped. Return the change in
+        the number of rows it occupies.
+
+        """
+        block_idx, offset = self._find_block(line_idx)
+        wrapped = self._wrapped[block_idx]
+        if wrapped[offset]:
+            return 0
+        wrapped[offset] = 1
+
+        block = self._blocks[block_idx]
+        extra = self._document.line_width(line_idx) // self._width
+        delta = extra - block[offset]
+        if delta != 0:
+            block[offset] = extra
+            _tree_add(self._extra_tree, block_idx, delta)
+        return delta
+
+    def lines_changed(self, first, n_removed, n_inserted):
+        """Record that n_removed lines starting at first have been replaced by
+        n_inserted lines. The new lines are unwrapped.
+
+        """
+        if n_removed == n_inserted:
+            self._unwrap(first, n_removed)
+            return
+
+        # Gather the blocks holding the removed lines into one
+        first_block, offset = self._find_block(first)
+        last_block, end = first_block, offset + n_removed
+        while end > len(self._blocks[last_block]) and (
+                last_block + 1 < len(self._blocks)):
+            end -= len(self._blocks[last_block])
+            last_block += 1
+        block, wrapped = array('q'), bytearray()
+        for block_idx in range(first_block, last_block + 1):
+            block.extend(self._blocks[block_idx])
+            wrapped.extend(self._wrapped[block_idx])
+
+        block[offset:offset + n_removed] = array('q', bytes(8 * n_inserted))
+        wrapped[offset:offset + n_removed] = bytes(n_inserted)
+
+        # Split the block if it has grown too large
+        size = WRAP_BLOCK_SIZE if len(block) > 2 * WRAP_BLOCK_SIZE else len(block)
+        starts = range(0, len(block), max(1, size))
+        self._blocks[first_block:last_block + 1] = [
+            block[start:start + size] for start in starts]
+        self._wrapped[first_block:last_block + 1] = [
+            wrapped[start:start + size] for start in starts]
+        if len(self._blocks) == 0:
+            self._blocks, self._wrapped = [array('q')], [bytearray()]
+        self._build_trees()
+
+    def row_of_line(self, line_idx):
+        """Return the index of the first row of a line. Passing the number of
+        lines gives the total number of rows.
+
+        """
+        block_idx, offset = self._find_block(line_idx)
+        return line_idx + _tree_prefix(self._extra_tree, block_idx) + sum(
+            self._blocks[block_idx][:offset])
+
+    def line_at_row(self, row):
+        """Return a (line index, row within line) pair for a row. Rows past the
+        last line give the number of lines and the number of rows past the
+        end.
+
+        """
+        line_tree, extra_tree = self._line_tree, self._extra_tree
+        n_blocks = len(self._blocks)
+
+        # Find the number of blocks which end at or before row
+        block_idx, lines_before, rows_before = 0, 0, 0
+        step = 1 << n_blocks.bit_length()
+        while step > 0:
+            next_idx = block_idx + step
+            if next_idx <= n_blocks:
+                block_rows = line_tree[next_idx] + extra_tree[next_idx]
+                if rows_before + block_rows <= row:
+                    block_idx = next_idx
+                    lines_before += line_tree[next_idx]
+                    rows_before += block_rows
+            step >>= 1
+
+        row -= rows_before
+        if block_idx < n_blocks:
+            block = self._blocks[block_idx]
+            if not any(block):
+                return lines_before + row, 0
+            for offset, extra in enumerate(block):
+                if row <= extra:
+                    return lines_before + offset, row
+                row -= extra + 1
+        return lines_before, row
+
+    def _reset(self, n_lines):
+        self._blocks = [
+            array('q', bytes(8 * min(WRAP_BLOCK_SIZE, n_lines - start)))
+            for start in range(0, n_lines, WRAP_BLOCK_SIZE)
+        ] or [array('q')]
+        self._wrapped = [bytearray(len(block)) for block in self._blocks]
+        self._build_trees()
+
+    def _unwrap(self, first, n_lines):
+        """Mark lines as unwrapped and counted as a single row."""
+        block_idx, offset = self._find_block(first)
+        while n_lines > 0 and block_idx < len(self._blocks):
+            block = self._blocks[block_idx]
+            end = min(len(block), offset + n_lines)
+            extra = sum(block[offset:end])
+            if extra != 0:
+                block[offset:end] = array('q', bytes(8 * (end - offset)))
+                _tree_add(self._extra_tree, block_idx, -extra)
+            self._wrapped[block_idx][offset:end] = bytes(end - offset)
+            n_lines -= end - offset
+            block_idx, offset = block_idx + 1, 0
+
+    def _find_block(self, line_idx):
+        """Return the index of the block holding a line and the offset of the
+        line within it. The end of the document is in the last block.
+
+        """
+        tree, n_blocks = self._line_tree, len(self._blocks)
+        block_idx, lines_before = 0, 0
+        step = 1 << n_blocks.bit_length()
+        while step > 0:
+            next_idx = block_idx + step
+            if next_idx <= n_blocks and (
+                    lines_before + tree[next_idx] <= line_idx):
+                block_idx = next_idx
+                lines_before += tree[next_idx]
+            step >>= 1
+
+        if block_idx == n_blocks:
+            block_idx -= 1
+            lines_before -= len(self._blocks[block_idx])
+        return block_idx, line_idx - lines_before
+
+    def _build_trees(self):
+        self._line_tree = _build_tree(len(block) for block in self._blocks)
+        self._extra_tree = _build_tree(sum(block) for block in self._blocks)
+
+def _build_tree(values):
+    """Return a Fenwick tree, indexed from 1, over an iterable of values."""
+    tree = array('q', [0])
+    tree.extend(values)
+    for idx in range(1, len(tree)):
+        parent = idx + (idx & -idx)
+        if parent < len(tree):
+            tree[parent] += tree[idx]
+    return tree
+
+def _tree_add(tree, idx, delta):
+    """Add delta to the value at 0-based index idx of a Fenwick tree."""
+    idx += 1
+    while idx < len(tree):
+        tree[idx] += delta
+        idx += idx & -idx
+
+def _tree_prefix(tree, n):
+    """Return the sum of the first n values in a Fenwick tree."""
+    total = 0
+    while n > 0:
+        total += tree[n]
+        n -= n & -n
+    return total
+
+class TextLines(collections.abc.Sequence):
+    """A read-only sequence view of the lines within a TextDocument."""
+    def __init__(self, document):
+        self._document = document
+
+    def __len__(self):
+        return self._document.max_row
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('line index out of range')
+        return self._document.get_line(idx)
+
 class TextLine:
-    # pylint: disable=too-few-public-methods
-    def __init__(self, s=''):
+    """A single line of a document along with its rendered form. The rendered
+    form is stored compactly as a string holding one codepoint per cell,
+    parallel bytes giving the style id of each cell and bytes giving the number
+    of cells each character in the text occupies. The right-hand cell of a
+    double-width character is represented by a NUL. Cells holding more than one
+    codepoint, such as a character followed by combining characters, are
+    recorded separately.
+
+    Conversion between character and cell indices uses a cumulative sum of the
+    character widths which is built the first time it is needed.
+
+    """
+    __slots__ = (
+        '_text', '_spans', '_col', '_blank', '_cell_text', '_styles',
+        '_widths', '_clusters', '_offsets')
+
+    def __init__(self, s='', spans=None, col=0, blank=None):
         self._text = s
-        self._rendered_widths = []
-        self._render()
+
+        # The spans lex() found in the line or None if the line is not
+        # highlighted
+        self._spans = spans
+
+        # The column the text starts at, which determines the width of tabs,
+        # and whether the line it is part of is blank, which determines how
+        # whitespace is shown. Cells are still indexed from zero.
+        self._col = col
+        self._blank = blank if blank is not None else s.isspace()
+
+        # Cells are rendered on first use
+        self._cell_text = None
+        self._styles = None
+        self._widths = None
+        self._clusters = None
+
+        # Cell index of the start of each character and of the end of the line
+        self._offsets = None
+
+    @property
+    def spans(self):
+        return self._spans
 
     @property
     def cells(self):
-        return self._cells
+        """A sequence of Cell instances for the line."""
+        return TextLineCells(self)
+
+    @property
+    def width(self):
+        """The width of the line in cells."""
+        if self._cell_text is None:
+            self._render()
+        return len(self._cell_text)
 
     @property
     def text(self):
         return self._text
 
-    @text.setter
-    def text(self, value):
-        self._text = value
-        self._render()
+    @property
+    def size_estimate(self):
+        """An estimate of the memory used by this line once rendered."""
+        return sys.getsizeof(self._text) + RENDERED_CHAR_SIZE * len(self._text)
+
+    def get_cell(self, idx):
+        """Return the Cell at a given column."""
+        if self._cell_text is None:
+            self._render()
+        char, style = self._cell_text[idx], self._styles[idx]
+        if char == '\0':
+            return WCHAR_RIGHT
+        if self._clusters is not None and idx in self._clusters:
+            return Cell(self._clusters[idx], Style(style))
+        return _make_cell(char, style)
+
+    def get_regions(self, start, end):
+        """Return the cells in columns [start, end) as a list of (text, style)
+        pairs with adjacent cells of the same style merged. The right half of a
+        double-width character is only included if it is in the first column.
+
+        """
+        if self._cell_text is None:
+            self._render()
+        cell_text, styles = self._cell_text[start:end], self._styles[start:end]
+        if len(cell_text) == 0:
+            return []
+
+        if cell_text[0] == '\0':
+            cell_text = WCHAR_RIGHT.char + cell_text[1:]
+        if self._clusters is not None:
+            cell_text = list(cell_text)
+            for idx, cluster in self._clusters.items():
+                if start <= idx < start + len(cell_text):
+                    cell_text[idx - start] = cluster
+
+        regions = []
+        for m in _STYLE_RUN_REGEX.finditer(styles):
+            run_start, run_end = m.span()
+            text = cell_text[run_start:run_end]
+            if self._clusters is not None:
+                text = ''.join(text)
+            text = text.replace('\0', '')
+            style = styles[run_start]
+            if len(regions) > 0 and regions[-1][1] == style:
+                regions[-1] = (regions[-1][0] + text, style)
+            elif len(text) > 0:
+                regions.append((text, style))
+
+        return regions
 
     def char_to_cell(self, idx):
         """Convert an index into text into a column co-ordinate."""
-        return sum(self._rendered_widths[:idx])
+        offsets = self._get_offsets()
+        return offsets[max(0, min(idx, len(offsets) - 1))]
 
     def cell_to_char(self, x):
-        """Convert a column co-ordinate to an index into text."""
-        w_sum = 0
-        for idx, w in enumerate(self._rendered_widths):
-            if w_sum + w > x:
-                return idx
-            w_sum += w
-        return len(self.text)
-
-    def insert_character_at(self, idx, ch):
-        self._text = self._text[:idx] + ch + self._text[idx:]
-        self._render()
+        """Convert a column co-ordinate to an index into text. Columns within a
+        multi-cell character map to that character.
+
+        """
+        # The character is the last one starting at or before x. Zero-width
+        # characters share a start with their successor and so are skipped.
+        return max(0, bisect.bisect_right(self._get_offsets(), x) - 1)
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            if self._cell_text is None:
+                self._render()
+            self._offsets = array(
+                'I', itertools.accumulate(self._widths, initial=0))
+        return self._offsets
 
     def _render(self):
-        self._cells = []
-        self._rendered_widths = []
+        text = self._text
+        spans = self._spans if self._spans is not None else []
+
+        if text.isascii() and (
+                text.isprintable() or text.replace('\t', '').isprintable()):
+            self._render_ascii(spans)
+        else:
+            self._render_unicode(spans)
 
-        lex_ids, _ = lex(self._text, start_lang('python'))
+    def _render_ascii(self, spans):
+        """Render a line of printable ASCII characters and tabs. Every other
+        character occupies exactly one cell and so cells are built a span or a
+        run between tabs at a time.
+
+        """
+        text = self._text
 
         # What character do we use to represent whitespace?
-        ws_char = '\u00b7' if self._text.isspace() else ' '
+        ws_char = '\u00b7' if self._blank else ' '
+        cell_text = text if ws_char == ' ' else text.replace(' ', ws_char)
+
+        # The style of each character. Spaces are whitespace whatever span they
+        # are in.
+        if len(spans) > 0:
+            char_styles = b''.join(
+                text[span.start:span.start + span.length].encode('ascii')
+                .translate(_ascii_style_table(lex_id_to_style(span.style)))
+                for span in spans
+            )
+        else:
+            char_styles = text.encode('ascii').translate(
+                _ascii_style_table(Style.HL_NORMAL))
+
+        if '\t' not in text:
+            self._cell_text = cell_text
+            self._styles = char_styles
+            self._widths = b'\x01' * len(text)
+            self._clusters = None
+            return
+
+        cells, styles, widths = [], bytearray(), bytearray()
+        tab_chars = '\u203a' + (TAB_SIZE-1) * ws_char
+        pos, x = 0, 0
+        while True:
+            tab_idx = text.find('\t', pos)
+            end = tab_idx if tab_idx >= 0 else len(text)
+            cells.append(cell_text[pos:end])
+            styles += char_styles[pos:end]
+            widths += b'\x01' * (end - pos)
+            x += end - pos
+            if tab_idx < 0:
+                break
+
+            tab_size = TAB_SIZE - ((x + self._col) % TAB_SIZE)
+            cells.append(tab_chars[:tab_size])
+            styles += bytes([Style.HL_TAB]) * tab_size
+            widths.append(tab_size)
+            x += tab_size
+            pos = tab_idx + 1
+
+        self._cell_text = ''.join(cells)
+        self._styles = bytes(styles)
+        self._widths = bytes(widths)
+        self._clusters = None
 
-        idx, x = 0, 0
-        while idx < len(self._text):
-            if self._text[idx] == '\t':
+    def _render_unicode(self, spans):
+        # pylint: disable=too-many-locals
+        text = self._text
+        cells, styles, widths = [], bytearray(), bytearray()
+        clusters = {}
+
+        # The style of the characters before span_end
+        spans = iter(spans)
+        span_end, span_style = 0, Style.HL_NORMAL
+
+        # What character do we use to represent whitespace?
+        ws_char = '\u00b7' if self._blank else ' '
+
+        x = 0
+        for idx, end_idx, w in segment(text):
+            if text[idx] == '\t':
                 # Handle tab
-                tab_size = TAB_SIZE - (x % TAB_SIZE)
+                tab_size = TAB_SIZE - ((x + self._col) % TAB_SIZE)
                 tab_chars = '\u203a' + (TAB_SIZE-1) * ws_char
-                self._cells.extend(
-                    Cell(c, Style.HL_TAB) for c in tab_chars[:tab_size])
-                self._rendered_widths.append(tab_size)
-                idx += 1
-            elif self._text[idx].isspace():
-                w = wcwidth(self._text[idx])
-                if w > 0:
-                    self._cells.extend([Cell(ws_char, Style.HL_WHITESPACE)] * w)
-                    self._rendered_widths.append(w)
-                    x += w
-                idx += len(self._text[idx])
+                cells.append(tab_chars[:tab_size])
+                styles.extend([Style.HL_TAB] * tab_size)
+                widths.append(tab_size)
+                x += tab_size
+            elif text[idx].isspace():
+                w = max(0, w)
+                cells.append(ws_char * w)
+                styles.extend([Style.HL_WHITESPACE] * w)
+                widths.append(w)
+                x += w
             else:
                 # Handle normal text
-                end_idx = idx + 1
-                while end_idx < len(self._text) and wcwidth(self._text[end_idx]) == 0:
-                    end_idx += 1
-                cell_text = self._text[idx:end_idx]
-                w = wcswidth(cell_text)
+                cell_text = text[idx:end_idx]
                 if w > 0:
-                    self._cells.append(Cell(
-                        cell_text, lex_id_to_style(lex_ids[idx])))
+                    while span_end <= idx:
+                        span = next(spans, None)
+                        if span is None:
+                            span_end, span_style = len(text), Style.HL_NORMAL
+                        else:
+                            span_end = span.start + span.length
+                            span_style = lex_id_to_style(span.style)
+                    if len(cell_text) > 1:
+                        clusters[x] = cell_text
+                    cells.append(cell_text[0])
+                    styles.append(span_style)
                     if w == 2:
-                        self._cells.append(WCHAR_RIGHT)
-                    self._rendered_widths.append(w)
+                        cells.append('\0')
+                        styles.append(Style.WCHAR_RIGHT)
                     x += w
-                idx = end_idx
+                widths.append(max(0, w))
+
+            # Any zero-width characters are drawn within the cluster's cells
+            widths.extend(bytes(end_idx - idx - 1))
+
+        self._cell_text = ''.join(cells)
+        self._styles = bytes(styles)
+        self._widths = bytes(widths)
+        self._clusters = clusters if len(clusters) > 0 else None
 
+class ChunkedTextLine:
+    """A line too long to be rendered as a whole. It has the same interface as
+    TextLine but is not highlighted.
+
+    The text is divided into chunks of about LINE_CHUNK_SIZE characters, each
+    of which is rendered as a TextLine when its cells are first needed. The
+    character index and column at which each chunk starts are recorded when the
+    line is created so that the chunk holding a given character or column can
+    be found with bisect.
+
+    """
+    __slots__ = (
+        '_text', '_blank', '_chunk_starts', '_chunk_cols', '_chunks')
+
+    def __init__(self, s):
+        self._text = s
+        self._blank = s.isspace()
+
+        # The character index and column of the start of each chunk and of the
+        # end of the line
+        self._chunk_starts, self._chunk_cols = array('Q', [0]), array('Q', [0])
+        if s.isascii() and s.isprintable():
+            # Every character occupies one cell
+            self._chunk_starts = array(
+                'Q', range(0, len(s), LINE_CHUNK_SIZE))
+            self._chunk_starts.append(len(s))
+            self._chunk_cols = self._chunk_starts
+        pos, x = self._chunk_starts[-1], self._chunk_cols[-1]
+        while pos < len(s):
+            end = min(pos + LINE_CHUNK_SIZE, len(s))
+
+            # Zero-width characters are drawn in the cells of the character
+            # before them and so must stay in its chunk
+            while end < len(s) and char_width(s[end]) == 0:
+                end += 1
+            x += text_width(s[pos:end], x)
+            pos = end
+            self._chunk_starts.append(pos)
+            self._chunk_cols.append(x)
+
+        # Rendered chunks keyed by chunk index, least recently used first
+        self._chunks = collections.OrderedDict()
+
+    @property
+    def spans(self):
+        # Long lines are not highlighted
+        return None
+
+    @property
+    def cells(self):
+        """A sequence of Cell instances for the line."""
+        return TextLineCells(self)
+
+    @property
+    def width(self):
+        """The width of the line in cells."""
+        return self._chunk_cols[-1]
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def size_estimate(self):
+        """An estimate of the memory used by this line and its cached
+        chunks.
+
+        """
+        return (
+            sys.getsizeof(self._text) + 16 * len(self._chunk_starts) +
+            RENDERED_CHAR_SIZE * LINE_CHUNK_SIZE * LINE_CHUNK_CACHE_SIZE
+        )
+
+    def get_cell(self, idx):
+        """Return the Cell at a given column."""
+        chunk_idx = self._chunk_at_col(idx)
+        return self._get_chunk(chunk_idx).get_cell(
+            idx - self._chunk_cols[chunk_idx])
+
+    def get_regions(self, start, end):
+        """As TextLine.get_regions(). Only the chunks overlapping the columns
+        are rendered.
+
+        """
+        regions = []
+        chunk_idx = self._chunk_at_col(start)
+        while chunk_idx < len(self._chunk_cols) - 1:
+            chunk_col = self._chunk_cols[chunk_idx]
+            if chunk_col >= end:
+                break
+            chunk_regions = self._get_chunk(chunk_idx).get_regions(
+                max(0, start - chunk_col), end - chunk_col)
+            for text, style in chunk_regions:
+                if len(regions) > 0 and regions[-1][1] == style:
+                    regions[-1] = (regions[-1][0] + text, style)
+                else:
+                    regions.append((text, style))
+            chunk_idx += 1
+        return regions
+
+    def char_to_cell(self, idx):
+        """Convert an index into text into a column co-ordinate."""
+        idx = max(0, min(idx, len(self._text)))
+        chunk_idx = min(
+            bisect.bisect_right(self._chunk_starts, idx) - 1,
+            len(self._chunk_starts) - 2)
+        if chunk_idx < 0:
+            return 0
+        return self._chunk_cols[chunk_idx] + self._get_chunk(
+            chunk_idx).char_to_cell(idx - self._chunk_starts[chunk_idx])
+
+    def cell_to_char(self, x):
+        """Convert a column co-ordinate to an index into text. Columns within a
+        multi-cell character map to that character.
+
+        """
+        chunk_idx = self._chunk_at_col(x)
+        if chunk_idx >= len(self._chunk_cols) - 1:
+            return 0
+        return self._chunk_starts[chunk_idx] + self._get_chunk(
+            chunk_idx).cell_to_char(x - self._chunk_cols[chunk_idx])
+
+    def _chunk_at_col(self, x):
+        """Return the index of the chunk holding column x."""
+        chunk_cols = self._chunk_cols
+        chunk_idx = bisect.bisect_right(chunk_cols, x, hi=len(chunk_cols) - 1)
+        return max(0, chunk_idx - 1)
+
+    def _get_chunk(self, chunk_idx):
+        chunk = self._chunks.get(chunk_idx)
+        if chunk is not None:
+            self._chunks.move_to_end(chunk_idx)
+            return chunk
+
+        start, end = self._chunk_starts[chunk_idx:chunk_idx + 2]
+        chunk = TextLine(
+            self._text[start:end], col=self._chunk_cols[chunk_idx],
+            blank=self._blank)
+        self._chunks[chunk_idx] = chunk
+        if len(self._chunks) > LINE_CHUNK_CACHE_SIZE:
+            self._chunks.popitem(last=False)
+        return chunk
+
+def make_text_line(s, spans=None):
+    """Return a TextLine for s highlighted with spans or a ChunkedTextLine if
+    it is longer than LONG_LINE_LENGTH characters.
+
+    """
+    if len(s) > LONG_LINE_LENGTH:
+        return ChunkedTextLine(s)
+    return TextLine(s, spans)
+
+class TextLineCells(collections.abc.Sequence):
+    """A read-only sequence view of the cells within a TextLine."""
+    __slots__ = ('_line',)
+
+    def __init__(self, line):
+        self._line = line
+
+    def __len__(self):
+        return self._line.width
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._line.get_cell(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('cell index out of range')
+        return self._line.get_cell(idx)
+
+# Matches runs of identical bytes. Used to find runs of cells with the same
+# style.
+_STYLE_RUN_REGEX = re.compile(rb'(.)\1*', re.DOTALL)
+
+@functools.lru_cache(maxsize=4096)
+def _make_cell(char, style):
+    """Return a shared Cell for a single character and style id."""
+    return Cell(char, Style(style))
+
+@functools.lru_cache(maxsize=None)
+def _ascii_style_table(style):
+    """Return a table for bytes.translate() which maps ASCII characters to
+    style, or to the whitespace style for a space.
+
+    """
+    table = bytearray([style]) * 256
+    table[ord(' ')] = Style.HL_WHITESPACE
+    return bytes(table)
+
+@functools.lru_cache(maxsize=None)
 def lex_id_to_style(lex_id):
+    """Return the Style for a style id from the lexer by following the chain
+    of styles it maps to until one in DEFAULT_LEX_STYLES is found.
+
+    """
+    seen = set()
+    while lex_id is not None and lex_id not in seen:
+        style = DEFAULT_LEX_STYLES.get(lex_id)
+        if style is not None:
+            return style
+        seen.add(lex_id)
+        lang_style = LANGUAGE_MANAGER.styles.get(lex_id)
+        lex_id = lang_style.map_to if lang_style is not None else None
     return Style.HL_NORMAL
@@ -1,67 +1,512 @@
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+import fnmatch
+import functools
+import io
+import mimetypes
+import os
+import pickle
 import re
+import sys
+import weakref
 from xml.etree import ElementTree
 
+from atomicwrites import atomic_write
 import pkg_resources
 
 class Context:
-    def __init__(self, elem, lang_id, manager, compile_regex_elem):
-        self.elem = elem
+    def __init__(self, elem, lang_id, manager, prepare_regex_elem):
+        # pylint: disable=unused-argument
+        self.id = elem.get('id')
         self.manager = manager
         self.style_ref = elem.get('style-ref')
         if self.style_ref is not None and ':' not in self.style_ref:
             self.style_ref = lang_id + ':' + self.style_ref
-        self._compile_regex_elem = compile_regex_elem
+
+        # Whether this context may continue past the end of its parent, whether
+        # its parent ends along with it and whether it may match only once
+        # within each instance of its parent
+        self.extend_parent = elem.get('extend-parent') != 'false'
+        self.end_parent = elem.get('end-parent') == 'true'
+        self.once_only = elem.get('once-only') == 'true'
+
+        # SubPatternContext instances styling groups within this context's
+        # matches
+        self.sub_patterns = ()
+
+    def iter_alternatives(self, seen):
+        """Yield (context, regex) pairs for each way in which this context may
+        be entered from a parent. The regex matches where the context starts.
+        Contexts already in the set seen are skipped to break reference
+        cycles.
+
+        """
+        # pylint: disable=unused-argument
+        return iter(())
+
+    def _try_compile(self, prepared):
+        """Compile a (regex, flags) pair from prepare_regex_elem returning
+        NEVER_REGEX if it is invalid.
+
+        """
+        try:
+            return self.manager.compile_regex(*prepared)
+        except (re.error, KeyError, ValueError):
+            return NEVER_REGEX
 
 class SimpleContext(Context):
-    def __init__(self, elem, lang_id, manager, compile_regex_elem):
-        Context.__init__(self, elem, lang_id, manager, compile_regex_elem)
+    def __init__(self, elem, lang_id, manager, prepare_regex_elem,
+                 sub_patterns=()):
+        Context.__init__(self, elem, lang_id, manager, prepare_regex_elem)
 
-        self._match_elem = elem.find('match')
-        assert self._match_elem is not None
+        match_elem = elem.find('match')
+        assert match_elem is not None
+        self._match = prepare_regex_elem(match_elem)
         self._re = None
+        self.sub_patterns = tuple(sub_patterns)
 
-    def match(self, text):
+    def get_regex(self):
         if self._re is None:
-            self._re = self._compile_regex_elem(self._match_elem)
-        m = self._re.match(text)
-        if not m:
-            return [], text
+            self._re = self._try_compile(self._match)
+        return self._re
 
-        match_text = m.group(0)
-        return [(self, match_text)], text[len(match_text):]
+    def match(self, text, pos=0):
+        """Return the match of this context at pos within text or None."""
+        return self.get_regex().match(text, pos)
+
+    def iter_alternatives(self, seen):
+        yield self, self.get_regex()
 
 class ContainerContext(Context):
-    def __init__(self, elem, lang_id, manager, compile_regex_elem, children):
-        Context.__init__(self, elem, lang_id, manager, compile_regex_elem)
-        self._compile_regex_elem = compile_regex_elem
+    def __init__(self, elem, lang_id, manager, prepare_regex_elem, children):
+        Context.__init__(self, elem, lang_id, manager, prepare_regex_elem)
         self._start_re, self._end_re = None, None
 
-        self.start_elem = elem.find('start')
-        self.end_elem = elem.find('end')
-        self.children = children
+        start_elem, end_elem = elem.find('start'), elem.find('end')
+        self._start = None
+        if start_elem is not None:
+            self._start = prepare_regex_elem(start_elem)
+        self._end = None
+        if end_elem is not None:
+            self._end = prepare_regex_elem(end_elem)
+
+        # Sub-patterns are not entered like other children but style the start
+        # and end matches
+        self.children = [
+            child for child in children
+            if not isinstance(child, SubPatternContext)
+        ]
+        self.sub_patterns = tuple(
+            child for child in children if isinstance(child, SubPatternContext)
+        )
+        self.end_at_line_end = elem.get('end-at-line-end') == 'true'
+        self.style_inside = elem.get('style-inside') == 'true'
+
+        # Whether the end regex refers to groups in the start match, in which
+        # case it is compiled afresh each time the context is entered
+        self.end_refers_to_start = (
+            self._end is not None and
+            START_REF_REGEX.search(self._end[0]) is not None
+        )
+
+    def get_start_regex(self):
+        if self._start_re is None and self._start is not None:
+            self._start_re = self._try_compile(self._start)
+        return self._start_re
+
+    def get_end_regex(self, start_match=None):
+        """Return the regex matching the end of this context or None if it has
+        no end. References of the form \\%{name@start} are replaced by the
+        text of that group within start_match.
+
+        """
+        if self._end is None:
+            return None
+        if not self.end_refers_to_start:
+            if self._end_re is None:
+                self._end_re = self._try_compile(self._end)
+            return self._end_re
 
-    def match(self, text):
-        return [], text
+        def start_group(m):
+            group = m.group('group')
+            if start_match is None:
+                return ''
+            start, end = match_group_span(
+                start_match, int(group) if group.isdigit() else group)
+            return re.escape(start_match.string[start:end])
+
+        regex, flags = self._end
+        try:
+            regex = START_REF_REGEX.sub(
+                start_group, self.manager.expand_regex(regex))
+            return compile_cached(regex, flags)
+        except (re.error, KeyError, ValueError):
+            return NEVER_REGEX
+
+    def iter_alternatives(self, seen):
+        if self._start is not None:
+            yield self, self.get_start_regex()
+        elif self not in seen:
+            # Contexts without a start are included into their parent.
+            seen.add(self)
+            for child in self.children:
+                yield from child.iter_alternatives(seen)
 
 class SubPatternContext(Context):
-    def __init__(self, elem, lang_id, manager, compile_regex_elem):
-        Context.__init__(self, elem, lang_id, manager, compile_regex_elem)
+    def __init__(self, elem, lang_id, manager, prepare_regex_elem):
+        Context.__init__(self, elem, lang_id, manager, prepare_regex_elem)
+
+        # The number or name of the group styled and the match it is found in:
+        # 'start' or 'end' for a container or 'default' for a simple context
+        group = elem.get('sub-pattern')
+        self.group = int(group) if group.isdigit() else group
+        self.where = elem.get('where') or 'default'
 
 class KeywordContext(Context):
-    def __init__(self, elem, lang_id, manager, compile_regex_elem):
-        Context.__init__(self, elem, lang_id, manager, compile_regex_elem)
+    def __init__(self, elem, lang_id, manager, prepare_regex_elem):
+        Context.__init__(self, elem, lang_id, manager, prepare_regex_elem)
+
+        prefix, suffix = r'\%[', r'\%]'
+        if elem.find('prefix') is not None:
+            prefix = elem.find('prefix').text or ''
+        if elem.find('suffix') is not None:
+            suffix = elem.find('suffix').text or ''
+        keywords = [k.text for k in elem.iterfind('keyword') if k.text]
+        _, flags = prepare_regex_elem(elem, '')
+        self._keywords = prepare_regex_elem(elem, '{}(?:{}){}'.format(
+            prefix, keywords_regex(keywords, flags), suffix))
+        self._re = None
+
+    def get_regex(self):
+        if self._re is None:
+            self._re = self._try_compile(self._keywords)
+        return self._re
+
+    def match(self, text, pos=0):
+        """Return the match of this context at pos within text or None."""
+        return self.get_regex().match(text, pos)
+
+    def iter_alternatives(self, seen):
+        yield self, self.get_regex()
 
 class ReferenceContext(Context):
-    def __init__(self, elem, lang_id, manager, compile_regex_elem):
-        Context.__init__(self, elem, lang_id, manager, compile_regex_elem)
+    def __init__(self, elem, lang_id, manager, prepare_regex_elem):
+        Context.__init__(self, elem, lang_id, manager, prepare_regex_elem)
+        self.ref = elem.get('ref')
+        if ':' not in self.ref:
+            self.ref = lang_id + ':' + self.ref
+
+    def iter_alternatives(self, seen):
+        if self in seen:
+            return
+        seen.add(self)
+
+        # A reference of the form "<lang>:*" includes the children of that
+        # language's root context.
+        ref_lang, ref_id = self.ref.split(':', 1)
+        if ref_id == '*':
+            target = self.manager.contexts.get(ref_lang + ':' + ref_lang)
+            for child in getattr(target, 'children', []):
+                yield from child.iter_alternatives(seen)
+            return
+
+        target = self.manager.contexts.get(self.ref)
+        if target is not None:
+            yield from target.iter_alternatives(seen)
+
+def keywords_regex(keywords, flags=0):
+    """Return a regex matching any of a list of keywords, each of which is
+    itself a regex, when compiled with flags. Runs of keywords which are
+    literal strings are combined into tries so that the regex engine need not
+    try each of them in turn. Keywords are preferred in the order given as
+    they are in an alternation.
+
+    """
+    # When ignoring case, keywords are added to the trie in lower case so that
+    # no two children of a node match the same character. Only ASCII keywords
+    # are added as other characters may match characters of other cases which
+    # lower() does not map them to.
+    ignore_case = flags & re.IGNORECASE
+    alternatives, trie = [], {}
+    for idx, keyword in enumerate(keywords):
+        literal = None
+        if LITERAL_KEYWORD_REGEX.fullmatch(keyword) is not None:
+            literal = ESCAPED_CHAR_REGEX.sub(r'\1', keyword)
+            if ignore_case:
+                literal = literal.lower() if literal.isascii() else None
+        if literal is None:
+            if len(trie) > 0:
+                alternatives.append(_trie_regex(trie))
+                trie = {}
+            alternatives.append(keyword)
+            continue
+
+        node = trie
+        for ch in literal:
+            node = node.setdefault(ch, {})
+        node.setdefault('', idx)
+
+    if len(trie) > 0:
+        alternatives.append(_trie_regex(trie))
+    return '|'.join(alternatives)
+
+def _trie_regex(node, lower=-1, upper=None):
+    """Return a regex matching the keywords in a trie built by
+    keywords_regex() whose indices are greater than lower and, if upper is not
+    None, less than upper. Return None if there are no such keywords.
+
+    """
+    def children_regex(lower, upper):
+        branches = []
+        for ch, child in node.items():
+            if ch != '':
+                regex = _trie_regex(child, lower, upper)
+                if regex is not None:
+                    branches.append(re.escape(ch) + regex)
+        return branches
+
+    # Children are distinct characters, ignoring case if need be, and so only
+    # one can match some text and their order is unimportant
+    idx = node.get('')
+    if idx is None or idx <= lower or (upper is not None and idx >= upper):
+        branches = children_regex(lower, upper)
+        if len(branches) == 0:
+            return None
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+
+    # The keyword ending here is tried after those which come before it and
+    # before those which come after it.
+    before, after = children_regex(lower, idx), children_regex(idx, upper)
+    if len(before) == 0 and len(after) == 0:
+        return ''
+    if len(after) == 0:
+        return '(?:' + '|'.join(before) + ')?'
+    if len(before) == 0:
+        return '(?:' + '|'.join(after) + ')??'
+    return '(?:' + '|'.join(before) + '||' + '|'.join(after) + ')'
+
+class Alternation:
+    """Finds the earliest match of any of a sequence of (value, regex)
+    alternatives with ties going to the alternative which comes first.
+
+    Alternatives are merged into a single regex with a named group for each so
+    that finding the winner needs one search. Alternatives which cannot be
+    merged, for example because they contain back-references or global flags,
+    are searched for individually.
+
+    Whether a regex matches at some position does not depend on where the
+    search started. So, if there are fallbacks, the match each regex found is
+    reused while a line is searched forwards until the line has been consumed
+    past its start. This keeps lexing a long line linear even if a fallback
+    never matches.
+
+    """
+    def __init__(self, alternatives):
+        self._alternatives = list(alternatives)
+        self._fallbacks = []
+
+        # The text last searched and, keyed by the index of a fallback or by
+        # None for the merged regex, the position each regex was searched from
+        # along with the match found
+        self._searched_text = None
+        self._searches = {}
+
+        merged = []
+        for idx, (_, regex) in enumerate(self._alternatives):
+            source = _scoped_source(regex)
+            if source is None:
+                self._fallbacks.append(idx)
+            else:
+                merged.append('(?P<_{}>{})'.format(idx, source))
+
+        self._re = None
+        if len(merged) > 0:
+            try:
+                self._re = compile_cached('|'.join(merged))
+            except re.error:
+                self._fallbacks = list(range(len(self._alternatives)))
+
+    def search(self, text, pos=0):
+        """Return a (value, match) pair for the earliest match in text at or
+        after pos or None if no alternative matches.
+
+        """
+        if len(self._fallbacks) == 0:
+            # The merged regex alone never searches past the match it returns
+            m = self._re.search(text, pos) if self._re is not None else None
+            if m is None:
+                return None
+            best_idx, best_start = int(m.lastgroup[1:]), m.start()
+        else:
+            best_idx, best_start = self._search_all(text, pos)
+
+        if best_idx is None:
+            return None
+
+        # Match again with the winning regex so that its groups are numbered as
+        # the context expects.
+        value, regex = self._alternatives[best_idx]
+        return value, regex.match(text, best_start)
+
+    def _search_all(self, text, pos):
+        """Return the index and start of the earliest match of any alternative
+        or (None, None).
+
+        """
+        if text is not self._searched_text:
+            self._searched_text, self._searches = text, {}
+
+        best_idx, best_start = None, None
+        if self._re is not None:
+            m = self._search(None, self._re, text, pos)
+            if m is not None:
+                best_idx, best_start = int(m.lastgroup[1:]), m.start()
+
+        for idx in self._fallbacks:
+            m = self._search(idx, self._alternatives[idx][1], text, pos)
+            if m is None:
+                continue
+            if best_idx is None or (m.start(), idx) < (best_start, best_idx):
+                best_idx, best_start = idx, m.start()
+
+        return best_idx, best_start
+
+    def _search(self, key, regex, text, pos):
+        searched_pos, m = self._searches.get(key, (None, None))
+        if searched_pos is None or searched_pos > pos or (
+                m is not None and m.start() < pos):
+            m = regex.search(text, pos)
+            self._searches[key] = (pos, m)
+        return m
 
 Language = namedtuple('Language', 'id name hidden root_context')
 Style = namedtuple('Style', 'name map_to')
 Regex = namedtuple('Regex', 'regex flags')
 
-FULLY_QUAL_ID_REGEX = re.compile(r'\\%{(?P<lang>[^:}]+):(?P<id>[^:}]+)}')
-UNQUAL_ID_REGEX = re.compile(r'\\%\{(?P<id>[^:}]+)\}')
+FULLY_QUAL_ID_REGEX = re.compile(r'\\%{(?P<lang>[^:}@]+):(?P<id>[^:}@]+)}')
+UNQUAL_ID_REGEX = re.compile(r'\\%\{(?P<id>[^:}@]+)\}')
+
+# Matches a reference within an end regex to a group in the start match.
+START_REF_REGEX = re.compile(r'\\%\{(?P<group>[^:}@]+)@start\}')
+
+# POSIX character classes, which Python's re does not support, along with their
+# equivalents for use within a bracket expression.
+POSIX_CLASS_REGEX = re.compile(r'\[:(?P<name>[a-z]+):\]')
+POSIX_CLASSES = {
+    'alnum': 'a-zA-Z0-9', 'alpha': 'a-zA-Z', 'digit': '0-9', 'space': r'\s',
+    'upper': 'A-Z', 'lower': 'a-z', 'xdigit': '0-9A-Fa-f',
+    'cntrl': r'\x00-\x1f\x7f', 'punct': r'!-/:-@\[-`{-~',
+}
+
+# Matches a "[" as the first character of a bracket expression. Python warns
+# about these since they may denote nested sets in future.
+BRACKET_IN_SET_REGEX = re.compile(r'(?<!\\)\[(\^?)\[(?!:)')
+
+def translate_regex(regex):
+    """Translate those parts of a GtkSourceView regex which Python's re
+    interprets differently.
+
+    """
+    regex = POSIX_CLASS_REGEX.sub(
+        lambda m: POSIX_CLASSES.get(m.group('name'), m.group(0)), regex)
+    regex = BRACKET_IN_SET_REGEX.sub(r'[\1\\[', regex)
+
+    # Python's re does not allow group names to be repeated, as the dupnames
+    # option does, so repeats are renamed. See match_group().
+    counts = defaultdict(int)
+    def rename_group(m):
+        name = m.group('name')
+        counts[name] += 1
+        if counts[name] == 1:
+            return m.group(0)
+        return '(?P<{}{}{}>'.format(name, DUP_GROUP_SEP, counts[name] - 1)
+    return NAMED_GROUP_REGEX.sub(rename_group, regex)
+
+# Matches the start of a named group capturing the name
+NAMED_GROUP_REGEX = re.compile(r'(?<!\\)\(\?P<(?P<name>\w+)>')
+
+# Separates the name of a repeated group from the number appended to it
+DUP_GROUP_SEP = '__'
+
+def match_group_span(m, group):
+    """Return the span of a numbered or named group within a match or (-1, -1)
+    if it did not participate. A named group which was repeated in the regex
+    matches if any of its repeats did.
+
+    """
+    try:
+        span = m.span(group)
+    except IndexError:
+        return -1, -1
+    idx = 1
+    while span[0] < 0 and isinstance(group, str):
+        try:
+            span = m.span(group + DUP_GROUP_SEP + str(idx))
+        except IndexError:
+            break
+        idx += 1
+    return span
+
+# Matches constructs which prevent a regex being embedded within a larger one:
+# numbered back-references and named groups.
+UNMERGEABLE_REGEX = re.compile(r'\\[1-9]|\(\?P[<=]')
+
+# A regex which never matches. Used in place of regexes which fail to compile.
+NEVER_REGEX = re.compile(r'(?!)')
+
+# The number of compiled regexes kept by compile_cached(). The cache is bounded
+# because end regexes which refer to their start match, and the alternations
+# they are merged into, are compiled for each distinct start text, such as
+# each heredoc delimiter in a file.
+REGEX_CACHE_SIZE = 2048
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def compile_cached(regex, flags=0):
+    """As re.compile() but the most recently used REGEX_CACHE_SIZE compiled
+    regexes are cached. Many contexts share patterns and the re module's own
+    cache is small.
+
+    """
+    return re.compile(regex, flags)
+
+# Matches a keyword which is a literal string once any escaped punctuation has
+# been unescaped by ESCAPED_CHAR_REGEX. A trailing unescaped backslash, as in
+# Haskell's lambda keyword, is taken literally.
+LITERAL_KEYWORD_REGEX = re.compile(
+    r'(?:[^\\.^$*+?{}\[\]|()\s#]|\\[^\w\s])*\\?')
+ESCAPED_CHAR_REGEX = re.compile(r'\\(.)')
+
+# Flags which may be applied to part of a regex along with their letters.
+SCOPED_FLAGS = (
+    (re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'),
+    (re.VERBOSE, 'x'),
+)
+
+def scope_flags(regex, flags):
+    """Wrap a regex in a group which applies flags to it alone."""
+    on = ''.join(letter for flag, letter in SCOPED_FLAGS if flags & flag)
+    off = ''.join(letter for flag, letter in SCOPED_FLAGS if not flags & flag)
+    if off != '':
+        on += '-' + off
+
+    # A comment in a verbose regex runs to the end of the line
+    end = '\n)' if flags & re.VERBOSE else ')'
+    return '(?' + on + ':' + regex + end
+
+def _scoped_source(regex):
+    """Return the source of a compiled regex such that it may be embedded
+    within another or None if that is not possible.
+
+    """
+    if UNMERGEABLE_REGEX.search(regex.pattern):
+        return None
+    source = scope_flags(regex.pattern, regex.flags)
+    try:
+        re.compile(source)
+    except re.error:
+        return None
+    return source
 
 def get_regex_flags(regex_or_match, base_flags=0):
     """Return flags for a regex or match element taking account of any
@@ -79,7 +524,6 @@ def get_regex_flags(regex_or_match, base_flags=0):
     elif regex_or_match.get('extended') == 'false':
         flags &= ~re.VERBOSE
 
-    # TODO: dupnames
     return flags
 
 def parse_language_tree(tree, manager):
@@ -116,7 +560,6 @@ def parse_language_tree(tree, manager):
     regex_flags = 0
     dro = language.find('default-regex-options')
     if dro is not None:
-        # TODO: implement "dupnames"
         if dro.get('case-sensitive') == 'false':
             regex_flags |= re.IGNORECASE
         if dro.get('extended') == 'true':
@@ -131,41 +574,35 @@ def parse_language_tree(tree, manager):
         # Handle word boundary substitutions
         regex = regex.replace(r'\%[', opening_delimiter)
         regex = regex.replace(r'\%]', closing_delimiter)
+        regex = translate_regex(regex)
         manager.add_regex(
             lang_id, regex_elem.get('id'), regex, flags)
 
-    # A specialised function for the language which will compile a regular
-    # expression contained within an element. The element's case-sensitive and
-    # extended attributes are respected and the language's default regex options
-    # are combined with it. Word boundary and regex references are expanded
-    # using the language manager.
-    def compile_regex_elem(elem):
-        regex = elem.text or ''
+    # A specialised function for the language which will prepare a regular
+    # expression contained within an element, or the regex passed instead of
+    # the element's text, for LanguageManager.compile_regex(). It returns a
+    # (regex, flags) pair. The element's case-sensitive and extended
+    # attributes are respected and the language's default regex options are
+    # combined with it. Word boundaries are substituted and regex references
+    # are fully qualified.
+    def prepare_regex_elem(elem, regex=None):
+        if regex is None:
+            regex = elem.text or ''
         regex = regex.replace(r'\%[', opening_delimiter)
         regex = regex.replace(r'\%]', closing_delimiter)
+        regex = translate_regex(regex)
 
         # Fully qualify any '\%{id}' references
         regex = UNQUAL_ID_REGEX.sub(r'\%{' + lang_id + r':\1}', regex)
 
-        # Handle any ID references
-        while True:
-            m = FULLY_QUAL_ID_REGEX.search(regex)
-            if not m:
-                break
-            regex = FULLY_QUAL_ID_REGEX.sub(
-                manager.get_regex(m.group('lang') + ':' + m.group('id')),
-                regex, count=1
-            )
-
-        flags = get_regex_flags(elem, regex_flags)
-        return re.compile(regex, flags)
+        return regex, get_regex_flags(elem, regex_flags)
 
     # Parse each context at the top-level
     lang_context = None
     for context_elem in language.iterfind('./definitions/context'):
         assert context_elem.get('sub-pattern') is None
         context = parse_context(
-            context_elem, lang_id, manager, compile_regex_elem)
+            context_elem, lang_id, manager, prepare_regex_elem)
         context_id = context_elem.get('id')
 
         if context_id == lang_id:
@@ -177,48 +614,244 @@ def parse_language_tree(tree, manager):
 
     return Language(lang_id, name, hidden, lang_context)
 
-def parse_context(context_elem, lang_id, manager, compile_regex_elem):
+def parse_context(context_elem, lang_id, manager, prepare_regex_elem):
     # Is this a reference context?
     if context_elem.get('ref') is not None:
         return ReferenceContext(
-            context_elem, lang_id, manager, compile_regex_elem)
+            context_elem, lang_id, manager, prepare_regex_elem)
 
     # Is this a keyword context?
     if context_elem.find('keyword') is not None:
         return KeywordContext(
-            context_elem, lang_id, manager, compile_regex_elem)
-
-    # Is this a simple context?
-    if context_elem.find('match') is not None:
-        return SimpleContext(context_elem, lang_id, manager, compile_regex_elem)
+            context_elem, lang_id, manager, prepare_regex_elem)
 
     # Is this a sub-pattern context?
     if context_elem.get('sub-pattern') is not None:
         return SubPatternContext(
-            context_elem, lang_id, manager, compile_regex_elem)
+            context_elem, lang_id, manager, prepare_regex_elem)
 
-    # This is a container
     children = [
-        parse_context(child, lang_id, manager, compile_regex_elem)
+        parse_context(child, lang_id, manager, prepare_regex_elem)
         for child in context_elem.iterfind('./include/context')
     ]
+
+    # Is this a simple context? Its children may only be sub-patterns.
+    if context_elem.find('match') is not None:
+        return SimpleContext(
+            context_elem, lang_id, manager, prepare_regex_elem, [
+                child for child in children
+                if isinstance(child, SubPatternContext)
+            ])
+
+    # This is a container
     return ContainerContext(
-        context_elem, lang_id, manager, compile_regex_elem, children)
+        context_elem, lang_id, manager, prepare_regex_elem, children)
+
+# A summary of a bundled language file which is read without parsing its
+# definitions. Globs and mimetypes are tuples of strings taken from the
+# language's metadata. Dependencies is a tuple of the ids of the other languages
+# whose styles, regexs or contexts it refers to.
+LanguageInfo = namedtuple(
+    'LanguageInfo', 'id name hidden globs mimetypes dependencies filename')
+
+# Matches a reference to a definition in some language within the text of a
+# language file. The language id is captured.
+LANG_REFERENCE_REGEX = re.compile(
+    rb'(?:\b(?:ref|map-to)="|\\%\{)([\w-]+):')
+
+def scan_language_file(data, filename):
+    """Return the LanguageInfo for the contents of a language file."""
+    root, properties = None, defaultdict(list)
+    for event, elem in ElementTree.iterparse(
+            io.BytesIO(data), events=('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and elem.tag == 'property':
+            properties[elem.get('name')].extend((elem.text or '').split(';'))
+        elif elem.tag in ('metadata', 'styles', 'definitions'):
+            # The metadata precedes any definitions
+            if event == 'end' or elem.tag != 'metadata':
+                break
+
+    lang_id = root.get('id')
+    dependencies = set(
+        ref.decode('ascii') for ref in LANG_REFERENCE_REGEX.findall(data))
+    dependencies.discard(lang_id)
+
+    return LanguageInfo(
+        lang_id, root.get('name') or root.get('_name'),
+        root.get('hidden') == 'true',
+        tuple(glob for glob in properties['globs'] if glob != ''),
+        tuple(mt for mt in properties['mimetypes'] if mt != ''),
+        tuple(sorted(dependencies)), filename,
+    )
+
+# Incremented whenever the form in which parsed languages are cached changes.
+CACHE_FORMAT_VERSION = 5
+
+def default_cache_dir():
+    """Return the directory parsed languages are cached in by default."""
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'red', 'lang')
 
 class LanguageManager:
-    def __init__(self):
+    def __init__(self, cache_dir=None):
+        """Parsed languages are cached within cache_dir or, if it is None,
+        default_cache_dir(). Pass False to disable the cache.
+
+        Only an index of the bundled languages is read initially. Languages
+        are loaded, along with those they refer to, by get_language().
+
+        """
+        # The LanguageInfo for each bundled language and the languages loaded
+        # so far, keyed by id
+        self.index = {}
+        self.languages = {}
+
         self.styles = {}
         self.regexs = {}
         self.contexts = {}
-        self._load_builtins()
 
-    def _load_builtins(self):
-        for lang_file in pkg_resources.resource_listdir(__name__, 'lang'):
-            if not lang_file.endswith('.lang'):
-                continue
+        # The source of each regex in self.regexs with references expanded.
+        # Filled in by get_regex().
+        self._expanded_regexs = {}
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self._load_index()
+
+    def get_language(self, lang_id):
+        """Return the Language with a given id, loading it and any languages it
+        depends on if necessary. Raises KeyError if there is no such language.
+
+        """
+        if lang_id not in self.languages:
+            to_load = [self.index[lang_id]]
+            while to_load:
+                info = to_load.pop()
+                if info.id in self.languages:
+                    continue
+                self._load_builtin(info.filename)
+                to_load.extend(
+                    self.index[dep_id] for dep_id in info.dependencies
+                    if dep_id in self.index
+                )
+        return self.languages[lang_id]
+
+    def guess_language(self, filename=None, mimetype=None):
+        """Return the id of the language of a file given its name and/or MIME
+        type or None if it is not known. Globs matching the file name are
+        preferred to the MIME type. If several globs match, the longest wins.
+
+        """
+        if filename is not None:
+            basename = os.path.basename(filename)
+            matches = [
+                (len(glob), info.id) for info in self.index.values()
+                for glob in info.globs if fnmatch.fnmatchcase(basename, glob)
+            ]
+            if len(matches) > 0:
+                return max(matches)[1]
+            if mimetype is None:
+                mimetype, _ = mimetypes.guess_type(filename)
+
+        if mimetype is not None:
+            for lang_id in sorted(self.index):
+                if mimetype in self.index[lang_id].mimetypes:
+                    return lang_id
+
+        return None
+
+    def _load_index(self):
+        lang_files = sorted(
+            lang_file
+            for lang_file in pkg_resources.resource_listdir(__name__, 'lang')
+            if lang_file.endswith('.lang')
+        )
+        lang_paths = [_lang_file_path(lang_file) for lang_file in lang_files]
+
+        if self.cache_dir:
+            cache_path = os.path.join(self.cache_dir, 'index.pickle')
+            key = _cache_key(*lang_paths)
+            index = self._read_cache(cache_path, key)
+            if index is not None:
+                self.index = index
+                return
+
+        for lang_file, lang_path in zip(lang_files, lang_paths):
+            with open(lang_path, 'rb') as f:
+                info = scan_language_file(f.read(), lang_file)
+            self.index[info.id] = info
+
+        if self.cache_dir:
+            self._write_cache(cache_path, key, self.index)
+
+    def _load_builtin(self, lang_file):
+        """Load a bundled language from the cache if possible. Otherwise parse
+        it and add it to the cache.
+
+        """
+        lang_path = _lang_file_path(lang_file)
+        if self.cache_dir:
+            cache_path = os.path.join(self.cache_dir, lang_file + '.pickle')
+            key = _cache_key(lang_path)
+            definitions = self._read_cache(cache_path, key)
+            if definitions is not None:
+                self._add_definitions(definitions)
+                return
+
+        with open(lang_path, 'rb') as f:
+            language = parse_language_tree(ElementTree.parse(f), self)
+        self.languages[language.id] = language
 
-            with pkg_resources.resource_stream(__name__, 'lang/' + lang_file) as f:
-                parse_language_tree(ElementTree.parse(f), self)
+        if self.cache_dir:
+            self._write_cache(cache_path, key, self._get_definitions(language))
+
+    def _get_definitions(self, language):
+        """Return a tuple of the language and the styles, regexs and contexts
+        it defines.
+
+        """
+        prefix = language.id + ':'
+        return (language,) + tuple(
+            {k: v for k, v in d.items() if k.startswith(prefix)}
+            for d in (self.styles, self.regexs, self.contexts)
+        )
+
+    def _add_definitions(self, definitions):
+        language, styles, regexs, contexts = definitions
+        self.languages[language.id] = language
+        self.styles.update(styles)
+        self.regexs.update(regexs)
+        self.contexts.update(contexts)
+
+    def _read_cache(self, cache_path, key):
+        """Return the object cached at cache_path if it was cached with the
+        same key or None otherwise.
+
+        """
+        try:
+            with open(cache_path, 'rb') as f:
+                unpickler = _CacheUnpickler(f, self)
+                if unpickler.load() != key:
+                    return None
+                return unpickler.load()
+        except Exception: # pylint: disable=broad-except
+            # A missing, stale or corrupt cache is simply rebuilt
+            return None
+
+    def _write_cache(self, cache_path, key, obj):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with atomic_write(cache_path, mode='wb', overwrite=True) as f:
+                pickler = _CachePickler(f, self)
+                pickler.dump(key)
+                pickler.dump(obj)
+        except (OSError, pickle.PicklingError):
+            pass
 
     def add_style(self, lang_id, style_id, name, map_to):
         full_id = lang_id + ':' + style_id
@@ -235,24 +868,323 @@ class LanguageManager:
         # Fully qualify any '\%{id}' references
         regex = UNQUAL_ID_REGEX.sub(r'\%{' + lang_id + r':\1}', regex)
 
+        if full_id in self.regexs:
+            self._expanded_regexs.clear()
         self.regexs[full_id] = Regex(regex, flags)
 
     def add_context(self, lang_id, ctx_id, ctx):
         full_id = lang_id + ':' + ctx_id
         self.contexts[full_id] = ctx
 
+    def compile_regex(self, regex, flags):
+        """Compile a regex prepared by a language after expanding references
+        to other regexes within it. See expand_regex().
+
+        """
+        return compile_cached(self.expand_regex(regex), flags)
+
+    def expand_regex(self, regex, _refs=()):
+        """Return regex with each reference to a regex added by add_regex()
+        replaced by its expanded source. Raises KeyError if a regex is unknown
+        and ValueError if regexes refer to themselves.
+
+        """
+        if r'\%{' not in regex:
+            return regex
+        def expand_ref(m):
+            return self.get_regex(m.group('lang') + ':' + m.group('id'), _refs)
+        return FULLY_QUAL_ID_REGEX.sub(expand_ref, regex)
+
+    def get_regex(self, full_id, _refs=()):
+        """Return the source of a regex added by add_regex() wrapped so that it
+        may be embedded within another regex. References to other regexes are
+        expanded. The result is remembered.
+
+        """
+        expanded = self._expanded_regexs.get(full_id)
+        if expanded is None:
+            if full_id in _refs:
+                raise ValueError('cyclic regex reference: ' + ' -> '.join(
+                    _refs[_refs.index(full_id):] + (full_id,)))
+            regex = self.regexs[full_id]
+            expanded = self.expand_regex(regex.regex, _refs + (full_id,))
+            expanded = scope_flags(expanded, regex.flags)
+            self._expanded_regexs[full_id] = expanded
+        return expanded
+
+def _lang_file_path(lang_file):
+    return pkg_resources.resource_filename(__name__, 'lang/' + lang_file)
+
+def _cache_key(*paths):
+    """Return the key identifying what has been cached from some files. It
+    changes whenever the files, this module or the version of Python do.
+
+    """
+    key = [CACHE_FORMAT_VERSION, sys.version_info[:2]]
+    for path in paths + (__file__,):
+        stat = os.stat(path)
+        key.extend((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(key)
+
+class _CachePickler(pickle.Pickler):
+    """Pickles languages. The manager which contexts refer to is not
+    pickled but replaced on loading by the manager loading them.
+
+    """
+    def __init__(self, file_object, manager):
+        pickle.Pickler.__init__(self, file_object, pickle.HIGHEST_PROTOCOL)
+        self._manager = manager
+
+    def persistent_id(self, obj):
+        return 'manager' if obj is self._manager else None
+
+class _CacheUnpickler(pickle.Unpickler):
+    def __init__(self, file_object, manager):
+        pickle.Unpickler.__init__(self, file_object)
+        self._manager = manager
+
+    def persistent_load(self, pid):
+        if pid != 'manager':
+            raise pickle.UnpicklingError('unknown persistent id')
+        return self._manager
+
 LANGUAGE_MANAGER = LanguageManager()
 
-def tool():
-    import os
-    import sys
-    from docopt import docopt
+class LexState:
+    """The state of the lexer at the end of some text. It is a stack of the
+    container contexts which have been entered. Context is the innermost and
+    parent is the state within which it was entered or None for the root
+    context of a language.
 
-    opts = docopt("""
-Usage:
-    {prog} <source>
-    """.format(prog=os.path.basename(sys.argv[0])))
+    End regex matches the end of the context, with any references to its start
+    match substituted, and once_used is a frozenset of the once-only contexts
+    which have already matched within it.
 
-    with open(opts['<source>']) as f:
-        for line in f:
-            pass
+    States are interned so that equal states are the same object. Comparing
+    states is therefore O(1) and each state's alternation is built once however
+    many lines end in it.
+
+    """
+    __slots__ = (
+        'parent', 'context', 'end_regex', 'once_used', 'depth', 'style',
+        '_alternation', '__weakref__',
+    )
+
+    def __new__(cls, parent, context, end_regex=None, once_used=frozenset()):
+        key = (parent, context, end_regex, once_used)
+        state = _LEX_STATES.get(key)
+        if state is not None:
+            return state
+
+        state = object.__new__(cls)
+        state.parent, state.context = parent, context
+        state.end_regex, state.once_used = end_regex, once_used
+        state.depth = parent.depth + 1 if parent is not None else 0
+        state._alternation = None
+
+        # The style of text within the context which no child matches
+        state.style = context.style_ref
+        if state.style is None and parent is not None:
+            state.style = parent.style
+
+        _LEX_STATES[key] = state
+        return state
+
+    def enter(self, context, start_match):
+        """Return the state after entering a container context whose start
+        matched within this one.
+
+        """
+        return LexState(self, context, context.get_end_regex(start_match))
+
+    def leave(self):
+        """Return the state after the context ends, along with any parents it
+        ends in turn. The root context is never left.
+
+        """
+        state = self
+        while state.parent is not None:
+            ended, state = state, state.parent
+            if not ended.context.end_parent:
+                break
+        return state
+
+    def use_once(self, context):
+        """Return the state after a once-only context matched within this
+        one.
+
+        """
+        return LexState(
+            self.parent, self.context, self.end_regex,
+            self.once_used | {context})
+
+    def at_line_end(self):
+        """Return the state after leaving the contexts which end at the end of
+        a line. Contexts are left from the innermost outwards and only while
+        each ends at the end of a line so that one which continues onto the
+        next line keeps its ancestors open.
+
+        """
+        state = self
+        while state.parent is not None and state.context.end_at_line_end:
+            state = state.parent
+        return state
+
+    def outer_style(self):
+        """The style of the start and end matches of the context."""
+        if self.parent is None:
+            return self.style
+        if self.context.style_inside or self.context.style_ref is None:
+            return self.parent.style
+        return self.context.style_ref
+
+    def search(self, text, pos=0):
+        """Search text from pos for the earliest match of either the end of
+        this context or of an ancestor it may not extend past or the start of
+        one of its children. Return a (value, match) pair where value is the
+        state whose context ended or the child context which matched. Return
+        None if there is no match.
+
+        """
+        if self._alternation is None:
+            self._alternation = Alternation(self._iter_alternatives())
+        return self._alternation.search(text, pos)
+
+    def _iter_alternatives(self):
+        # Ancestors' ends take priority over the ends within them.
+        ends, state = [], self
+        while state is not None:
+            if state.end_regex is not None:
+                ends.append((state, state.end_regex))
+            if state.context.extend_parent:
+                break
+            state = state.parent
+        yield from reversed(ends)
+
+        seen = {self.context}
+        for child in self.context.children:
+            for context, regex in child.iter_alternatives(seen):
+                if context not in self.once_used:
+                    yield context, regex
+
+# Interned LexState instances keyed by their parent, context, end regex and
+# used once-only contexts
+_LEX_STATES = weakref.WeakValueDictionary()
+
+def start_lang(lang_id, manager=LANGUAGE_MANAGER):
+    """Return the LexState for the start of some text in a language."""
+    root_context = manager.get_language(lang_id).root_context
+    return LexState(None, root_context, root_context.get_end_regex())
+
+# A run of characters within a line which share a style. Style is a fully
+# qualified style id or None.
+Span = namedtuple('Span', 'start length style')
+
+class _SpanBuilder:
+    """Builds a list of Span instances from styled ranges of a line given in
+    order. Adjacent ranges with the same style are merged.
+
+    """
+    def __init__(self):
+        self.spans = []
+        self._start, self._end, self._style = 0, 0, None
+
+    def add(self, start, end, style):
+        start = max(start, self._end)
+        if end <= start:
+            return
+        if style != self._style or start > self._end:
+            self.finish()
+            self._start, self._style = start, style
+        self._end = end
+
+    def add_match(self, m, style, sub_patterns, where):
+        """Add the text of a match. Those groups named by sub-patterns found
+        where given are styled by them with later sub-patterns taking priority.
+
+        """
+        start, end = m.span()
+        ranges = []
+        for sub_pattern in sub_patterns:
+            if sub_pattern.where != where:
+                continue
+            group_start, group_end = match_group_span(m, sub_pattern.group)
+            group_start, group_end = max(group_start, start), min(group_end, end)
+            if group_end > group_start:
+                ranges.append(
+                    (group_start, group_end, sub_pattern.style_ref or style))
+
+        if len(ranges) == 0:
+            self.add(start, end, style)
+            return
+
+        bounds = sorted(
+            {start, end} | {r[0] for r in ranges} | {r[1] for r in ranges})
+        for piece_start, piece_end in zip(bounds, bounds[1:]):
+            piece_style = style
+            for group_start, group_end, group_style in ranges:
+                if group_start <= piece_start and piece_end <= group_end:
+                    piece_style = group_style
+            self.add(piece_start, piece_end, piece_style)
+
+    def finish(self):
+        if self._end > self._start:
+            self.spans.append(
+                Span(self._start, self._end - self._start, self._style))
+        self._start = self._end
+
+def lex(text, state):
+    """Lex a line of text starting in state. Return a list of Span instances
+    covering the line, in order, along with the state at the end of the line.
+    Adjacent spans have different styles.
+
+    """
+    builder = _SpanBuilder()
+    pos, empty_matches = 0, 0
+
+    while pos < len(text):
+        result = state.search(text, pos)
+        if result is None:
+            break
+        value, m = result
+        start, end = m.span()
+
+        # Text before the match is within the current context
+        builder.add(pos, start, state.style)
+
+        if isinstance(value, LexState):
+            # The end of the current context or of an ancestor
+            builder.add_match(
+                m, value.outer_style(), value.context.sub_patterns, 'end')
+            state = value.leave()
+        else:
+            if value.once_only:
+                state = state.use_once(value)
+            if isinstance(value, ContainerContext):
+                state = state.enter(value, m)
+                builder.add_match(
+                    m, state.outer_style(), value.sub_patterns, 'start')
+            else:
+                builder.add_match(
+                    m, value.style_ref or state.style, value.sub_patterns,
+                    'default')
+                if value.end_parent:
+                    state = state.leave()
+        pos = end
+
+        # Empty matches could otherwise repeat forever. Allow a few, since
+        # entering or leaving a context may legitimately match nothing, but
+        # then skip a character.
+        if end == start:
+            empty_matches += 1
+            if empty_matches > state.depth + 2:
+                builder.add(pos, pos + 1, state.style)
+                pos += 1
+                empty_matches = 0
+        else:
+            empty_matches = 0
+
+    builder.add(pos, len(text), state.style)
+    builder.finish()
+
+    return builder.spans, state.at_line_end()
@@ -0,0 +1,202 @@
+"""
+Tokenise source files in bulk using red's highlighter.
+
+Usage:
+    {prog} [options] <path>...
+
+Options:
+    -f FORMAT, --format=FORMAT  Output format: "jsonl" for one JSON object of
+                                token spans per file or "ansi" for text
+                                highlighted with terminal escapes.
+                                [default: jsonl]
+    -j JOBS, --jobs=JOBS        Number of worker processes. Defaults to the
+                                number of CPUs.
+    -l LANG, --language=LANG    Tokenise every file as the language with this
+                                id rather than guessing from file names.
+    -q, --quiet                 Do not report throughput.
+
+Directories are searched recursively for files of a known language. Each JSON
+object has "path", "language" and "lines" keys. Lines is a list with, for each
+line of the file, a list of [start, length, style] spans.
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sys
+import time
+
+from docopt import docopt
+
+from .document import Style, lex_id_to_style
+from .language import LANGUAGE_MANAGER, lex, start_lang
+
+# The SGR parameters used to highlight each style in ANSI output. Colours match
+# those used by the editor.
+ANSI_STYLES = {
+    Style.HL_ERROR: '97;41',
+    Style.HL_KEYWORD: '1',
+    Style.HL_COMMENT: '38;5;87',
+    Style.HL_STRING: '38;5;227',
+    Style.HL_CONSTANT: '38;5;207',
+    Style.HL_TYPE: '38;5;83',
+    Style.HL_PREPROCESSOR: '38;5;34',
+    Style.HL_SPECIAL: '38;5;203',
+}
+
+# Number of files sent to a worker at a time
+FILES_PER_TASK = 8
+
+def main():
+    opts = docopt(__doc__.format(prog=os.path.basename(sys.argv[0])))
+
+    output_format = opts['--format']
+    if output_format not in ('jsonl', 'ansi'):
+        sys.exit('unknown output format: ' + output_format)
+    lang_id = opts['--language']
+    if lang_id is not None and lang_id not in LANGUAGE_MANAGER.index:
+        sys.exit('unknown language: ' + lang_id)
+    if lang_id is not None and (
+            LANGUAGE_MANAGER.get_language(lang_id).root_context is None):
+        # Hidden languages such as gtk-doc only provide definitions for others
+        sys.exit('language cannot be tokenised on its own: ' + lang_id)
+    jobs = opts['--jobs']
+    if jobs is not None:
+        if not jobs.isdigit() or int(jobs) < 1:
+            sys.exit('number of jobs must be a positive integer: ' + jobs)
+        jobs = int(jobs)
+
+    failed = False
+    tasks = []
+    for path, file_lang_id in find_files(opts['<path>'], lang_id):
+        if file_lang_id is None:
+            print('{}: language not known'.format(path), file=sys.stderr)
+            failed = True
+        else:
+            tasks.append((path, file_lang_id, output_format))
+
+    start_time = time.monotonic()
+    n_files, n_bytes = 0, 0
+    for path, result, size in _run(tasks, jobs, lang_id):
+        if size is None:
+            print('{}: {}'.format(path, result), file=sys.stderr)
+            failed = True
+            continue
+        if output_format == 'ansi' and len(tasks) > 1:
+            sys.stdout.write('==> {} <==\n'.format(path))
+        sys.stdout.write(result)
+        n_files += 1
+        n_bytes += size
+    sys.stdout.flush()
+    elapsed = max(time.monotonic() - start_time, 1e-6)
+
+    if not opts['--quiet']:
+        print(
+            'tokenised {} files ({:.1f} MB) in {:.2f}s: '
+            '{:.1f} files/s, {:.2f} MB/s'.format(
+                n_files, n_bytes / 1e6, elapsed,
+                n_files / elapsed, n_bytes / 1e6 / elapsed),
+            file=sys.stderr)
+
+    if failed:
+        sys.exit(1)
+
+def find_files(paths, lang_id=None):
+    """Yield (path, language id) pairs for each file named by or within the
+    directories named by paths. The language is lang_id if it is not None and
+    is guessed from the file name otherwise. Files within directories whose
+    language is not known are skipped. For other files it is None.
+
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, lang_id or LANGUAGE_MANAGER.guess_language(path)
+            continue
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                file_lang_id = (
+                    lang_id or LANGUAGE_MANAGER.guess_language(file_path))
+                if file_lang_id is not None:
+                    yield file_path, file_lang_id
+
+def tokenise_file(path, lang_id, output_format='jsonl'):
+    """Tokenise a file as the language with id lang_id. Return its output in
+    output_format along with its size in bytes.
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    text = data.decode('utf-8', errors='replace')
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+
+    state = start_lang(lang_id)
+    if output_format == 'ansi':
+        output = []
+        for line in lines:
+            spans, state = lex(line, state)
+            output.append(format_ansi(line, spans))
+        return ''.join(output), len(data)
+
+    line_spans = []
+    for line in lines:
+        spans, state = lex(line, state)
+        line_spans.append([list(span) for span in spans])
+    record = {'path': path, 'language': lang_id, 'lines': line_spans}
+    return json.dumps(record, separators=(',', ':')) + '\n', len(data)
+
+def format_ansi(line, spans):
+    """Return a line, followed by a newline, with terminal escapes
+    highlighting its spans.
+
+    """
+    parts = []
+    for span in spans:
+        text = line[span.start:span.start + span.length]
+        sgr = ANSI_STYLES.get(lex_id_to_style(span.style))
+        if sgr is None:
+            parts.append(text)
+        else:
+            parts.append('\x1b[' + sgr + 'm' + text + '\x1b[0m')
+    parts.append('\n')
+    return ''.join(parts)
+
+def _run(tasks, jobs, lang_id):
+    """Tokenise each (path, language id, output format) task. Yield, in the
+    order of the tasks, (path, output, size) or, if the file could not be read
+    or tokenised, (path, error message, None).
+
+    """
+    if jobs == 1:
+        _init_worker(lang_id)
+        yield from map(_tokenise_task, tasks)
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(lang_id,)) as executor:
+        yield from executor.map(
+            _tokenise_task, tasks, chunksize=FILES_PER_TASK)
+
+def _init_worker(lang_id):
+    """Prepare a worker process. Each worker keeps the languages it loads in
+    LANGUAGE_MANAGER for every file it is given.
+
+    """
+    if lang_id is not None:
+        LANGUAGE_MANAGER.get_language(lang_id)
+
+def _tokenise_task(task):
+    path, lang_id, output_format = task
+    try:
+        output, size = tokenise_file(path, lang_id, output_format)
+    except OSError as e:
+        return path, e.strerror or str(e), None
+    except Exception as e:  # pylint: disable=broad-except
+        # One file failing to tokenise should not stop the others
+        return path, '{}: {}'.format(type(e).__name__, e), None
+    return path, output, size
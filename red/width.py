@@ -0,0 +1,134 @@
+"""
+Cell widths of characters and the segmentation of text into clusters.
+
+The widths which wcwidth() gives characters in the Basic Multilingual Plane are
+held in a table indexed by codepoint. Each page of 256 codepoints is filled in
+the first time one of its characters is looked up and so only the pages which
+text actually uses are ever computed. Characters outside of the BMP are rare
+and their widths are cached individually.
+
+A cluster is a character which occupies cells followed by any zero-width
+characters, such as combining marks, which are drawn within its cells. Text is
+segmented by looking up the width of each character once and splitting the
+resulting widths with a regex.
+
+"""
+import functools
+import re
+
+from wcwidth import wcwidth
+
+# Values in WIDTHS for characters which occupy no cells because they are not
+# printable and for characters whose page has not yet been filled.
+NON_PRINTABLE = 0xff
+UNKNOWN = 0xfe
+
+# The width of each BMP codepoint. Non-printable characters, for which wcwidth()
+# returns -1, are NON_PRINTABLE.
+WIDTHS = bytearray([UNKNOWN]) * 0x10000
+
+# Codepoints per page of WIDTHS
+PAGE_SIZE = 0x100
+
+# Strings at most this long have their width and clusters cached by
+# text_width() and segment(). This covers most lines and the regions of text
+# drawn on-screen.
+CACHED_TEXT_LENGTH = 256
+
+def _fill_page(page):
+    start = page * PAGE_SIZE
+    WIDTHS[start:start + PAGE_SIZE] = bytes(
+        wcwidth(chr(cp)) & 0xff for cp in range(start, start + PAGE_SIZE))
+
+_fill_page(0)
+
+# A table for bytes.translate() mapping ASCII characters to their widths
+_ASCII_WIDTHS = bytes(WIDTHS[:0x80]) + bytes([NON_PRINTABLE]) * 0x80
+
+@functools.lru_cache(maxsize=None)
+def _astral_width(ch):
+    return wcwidth(ch) & 0xff
+
+def char_width(ch):
+    """As wcwidth() but widths are looked up in WIDTHS."""
+    cp = ord(ch)
+    if cp >= 0x10000:
+        w = _astral_width(ch)
+    else:
+        w = WIDTHS[cp]
+        if w == UNKNOWN:
+            _fill_page(cp // PAGE_SIZE)
+            w = WIDTHS[cp]
+    return w if w != NON_PRINTABLE else -1
+
+def char_widths(text):
+    """Return bytes giving the width of each character in text. Non-printable
+    characters are NON_PRINTABLE.
+
+    """
+    if text.isascii():
+        return text.encode('ascii').translate(_ASCII_WIDTHS)
+
+    if max(text) >= '\U00010000':
+        _fill_pages(text)
+        return bytes(
+            WIDTHS[ord(ch)] if ch < '\U00010000' else _astral_width(ch)
+            for ch in text
+        )
+
+    widths = bytes(map(WIDTHS.__getitem__, map(ord, text)))
+    if UNKNOWN in widths:
+        _fill_pages(text)
+        widths = bytes(map(WIDTHS.__getitem__, map(ord, text)))
+    return widths
+
+def _fill_pages(text):
+    """Fill the pages of WIDTHS used by the BMP characters in text."""
+    for page in {ord(ch) // PAGE_SIZE for ch in set(text)}:
+        if page * PAGE_SIZE < len(WIDTHS) and (
+                WIDTHS[page * PAGE_SIZE] == UNKNOWN):
+            _fill_page(page)
+
+def text_width(text):
+    """As wcswidth() but widths are looked up in WIDTHS. The widths of short
+    strings are cached.
+
+    """
+    if len(text) <= CACHED_TEXT_LENGTH:
+        return _cached_text_width(text)
+    return _text_width(text)
+
+def _text_width(text):
+    if text.isascii() and text.isprintable():
+        return len(text)
+    widths = char_widths(text)
+    return sum(widths) if NON_PRINTABLE not in widths else -1
+
+_cached_text_width = functools.lru_cache(maxsize=4096)(_text_width)
+
+# Matches a cluster within the widths of some text: a character occupying cells
+# or which is not printable followed by any zero-width characters. Zero-width
+# characters at the start of the text form a cluster of their own.
+_CLUSTER_REGEX = re.compile(rb'[^\x00]\x00*|\x00+')
+
+def segment(text):
+    """Split text into clusters. Return a sequence of (start, end, width)
+    tuples giving the range of characters within text which each cluster covers
+    and the width of its first character. Widths are as returned by
+    char_width(). The clusters of short strings are cached.
+
+    """
+    if len(text) <= CACHED_TEXT_LENGTH:
+        return _cached_segment(text)
+    return _segment(text)
+
+def _segment(text):
+    widths = char_widths(text)
+    clusters = []
+    for m in _CLUSTER_REGEX.finditer(widths):
+        start, end = m.span()
+        w = widths[start]
+        clusters.append((start, end, w if w != NON_PRINTABLE else -1))
+    return tuple(clusters)
+
+_cached_segment = functools.lru_cache(maxsize=4096)(_segment)